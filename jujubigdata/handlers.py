@@ -11,8 +11,10 @@
 # Apache License for more details.
 
 import os
-import sys
-from subprocess import check_call, check_output
+import hashlib
+import socket
+from subprocess import check_call
+from tempfile import TemporaryFile
 from path import Path
 
 import jujuresources
@@ -20,7 +22,7 @@ import jujuresources
 from charmhelpers.core import hookenv
 from charmhelpers.core import unitdata
 from charmhelpers.core import host
-from charms.templating.jinja2 import render
+from jinja2 import Environment, FileSystemLoader
 
 try:
     from charmhelpers.core.charmframework import helpers
@@ -31,6 +33,22 @@ except ImportError:
 from jujubigdata import utils
 
 
+_PKG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# compiled templates are cached by the environment across calls
+_template_env = Environment(loader=FileSystemLoader(_PKG_DIR))
+_init_system_cache = {}
+
+
+def _init_is_systemd():
+    """
+    Cached version of :func:`host.init_is_systemd`.
+    """
+    if 'systemd' not in _init_system_cache:
+        _init_system_cache['systemd'] = host.init_is_systemd()
+    return _init_system_cache['systemd']
+
+
 class HadoopBase(object):
     def __init__(self, dist_config):
         self.dist_config = dist_config
@@ -51,6 +69,17 @@ class HadoopBase(object):
                 'ies' if len(missing_dirs) > 1 else 'y',
                 ', '.join(missing_dirs)))
 
+        # Resolve all ports from dist.yaml up front; they are looked up
+        # repeatedly while configuring the various Hadoop services.  (Paths
+        # are cached by DistConfig.path itself.)
+        self._ports = {name: self.dist_config.port(name)
+                       for name in getattr(self.dist_config, 'ports', {}).keys()}
+        # the parts of the init script context shared by all services
+        self._init_script_context = {
+            'hadoop_path': self.dist_config.path('hadoop'),
+            'hadoop_conf': self.dist_config.path('hadoop_conf'),
+        }
+
         # Build a list of hadoop resources needed from resources.yaml
         self.resources = {
             'java-installer': 'java-installer',
@@ -91,6 +120,18 @@ class HadoopBase(object):
         else:
             return None
 
+    def path(self, key):
+        """
+        Return the resolved path for the given dir key from dist.yaml.
+        """
+        return self.dist_config.path(key)
+
+    def port(self, key):
+        """
+        Return the port for the given key from dist.yaml, or ``None``.
+        """
+        return self._ports.get(key)
+
     def is_installed(self):
         return unitdata.kv().get('hadoop.base.installed')
 
@@ -105,8 +146,9 @@ class HadoopBase(object):
         self.install_base_packages()
         self.setup_hadoop_config()
         self.configure_hadoop()
-        unitdata.kv().set('hadoop.base.installed', True)
-        unitdata.kv().flush(True)
+        kv = unitdata.kv()
+        kv.set('hadoop.base.installed', True)
+        utils.flush_kv_on_exit()
         hookenv.status_set('waiting', 'Apache Hadoop base installed')
 
     def configure_hosts_file(self):
@@ -125,8 +167,13 @@ class HadoopBase(object):
         # the /etc/hostname lest Hadoop get confused about where certain things
         # should be run)
         etc_hostname = Path('/etc/hostname')
-        etc_hostname.write_text(hostname)
-        check_call(['hostname', '-F', etc_hostname])
+        if not etc_hostname.exists() or etc_hostname.text().strip() != hostname:
+            etc_hostname.write_text(hostname + '\n')
+        if socket.gethostname() != hostname:
+            if hasattr(socket, 'sethostname'):
+                socket.sethostname(hostname)
+            else:
+                check_call(['hostname', '-F', etc_hostname])  # Python 2
 
     def install_base_packages(self):
         with utils.disable_firewall():
@@ -143,11 +190,24 @@ class HadoopBase(object):
 
         If there is an error installing Java, the installer should exit
         with a non-zero exit code.
+
+        The installer is skipped if this same installer has already been
+        run successfully and the JAVA_HOME it reported still exists.
         """
-        env = utils.read_etc_env()
+        kv = unitdata.kv()
         java_installer = Path(jujuresources.resource_path('java-installer'))
+        installer_hash = java_installer.read_hexhash('sha256')
+        java_home = kv.get('java.home')
+        if kv.get('java.installer.hash') == installer_hash and java_home and Path(java_home).exists():
+            return
+        env = utils.read_etc_env()
         java_installer.chmod(0o755)
-        output = check_output([java_installer], env=env).decode('utf8')
+        # Collect stdout in a temp file instead of buffering it in memory;
+        # stderr is left alone so that it ends up in the hook log.
+        with TemporaryFile('w+b') as out:
+            check_call([java_installer], stdout=out, env=env)
+            out.seek(0)
+            output = out.read().decode('utf8')
         lines = output.strip().splitlines()
         if len(lines) != 2:
             raise ValueError('Unexpected output from java-installer: %s' % output)
@@ -156,69 +216,98 @@ class HadoopBase(object):
             java_major, java_release = java_version.split("_")
         else:
             java_major, java_release = java_version, ''
-        unitdata.kv().set('java.home', java_home)
-        unitdata.kv().set('java.version', java_major)
-        unitdata.kv().set('java.version.release', java_release)
+        kv.set('java.home', java_home)
+        kv.set('java.version', java_major)
+        kv.set('java.version.release', java_release)
+        kv.set('java.installer.hash', installer_hash)
+        utils.flush_kv_on_exit()
 
     def install_hadoop(self):
         jujuresources.install(self.resources['hadoop'],
-                              destination=self.dist_config.path('hadoop'),
+                              destination=self.path('hadoop'),
                               skip_top_level=True)
 
         # Install our lzo compression codec if it's defined in resources.yaml
         if 'lzo' in self.resources:
             jujuresources.install(self.resources['lzo'],
-                                  destination=self.dist_config.path('hadoop'),
+                                  destination=self.path('hadoop'),
                                   skip_top_level=False)
+            # remember where the jars landed so configure_hadoop needn't search
+            unitdata.kv().set('hadoop.lzo_jars', [str(jar) for jar in self._find_lzo_jars()])
+            utils.flush_kv_on_exit()
         else:
             msg = ("The hadoop-lzo-%s resource was not found."
                    "LZO compression will not be available." % self.cpu_arch)
             hookenv.log(msg)
 
+    def _find_lzo_jars(self):
+        """
+        Locate the hadoop-lzo jar(s) unpacked into the Hadoop home.
+
+        The likely locations are checked first, and only if none of those
+        match is the (large) Hadoop tree walked.
+        """
+        hadoop_home = self.path('hadoop')
+        for pattern in ('hadoop-lzo-*.jar',
+                        '*/hadoop-lzo-*.jar',
+                        'share/hadoop/common/lib/hadoop-lzo-*.jar'):
+            jars = hadoop_home.glob(pattern)
+            if jars:
+                return sorted(jars)
+        return list(hadoop_home.walkfiles('hadoop-lzo-*.jar'))
+
     def setup_hadoop_config(self):
         # copy default config into alternate dir
-        conf_dir = self.dist_config.path('hadoop') / 'etc/hadoop'
-        self.dist_config.path('hadoop_conf').rmtree_p()
-        conf_dir.copytree(self.dist_config.path('hadoop_conf'))
-        (self.dist_config.path('hadoop_conf') / 'slaves').remove_p()
-        mapred_site = self.dist_config.path('hadoop_conf') / 'mapred-site.xml'
+        conf_dir = self.path('hadoop') / 'etc/hadoop'
+        self.path('hadoop_conf').rmtree_p()
+        conf_dir.copytree(self.path('hadoop_conf'))
+        (self.path('hadoop_conf') / 'slaves').remove_p()
+        mapred_site = self.path('hadoop_conf') / 'mapred-site.xml'
         if not mapred_site.exists():
-            (self.dist_config.path('hadoop_conf') / 'mapred-site.xml.template').copy(mapred_site)
+            (self.path('hadoop_conf') / 'mapred-site.xml.template').copy(mapred_site)
 
     def configure_hadoop(self):
-        java_home = Path(unitdata.kv().get('java.home'))
+        kv = unitdata.kv()
+        java_home = Path(kv.get('java.home'))
         java_bin = java_home / 'bin'
-        hadoop_home = self.dist_config.path('hadoop')
+        hadoop_home = self.path('hadoop')
         hadoop_bin = hadoop_home / 'bin'
         hadoop_sbin = hadoop_home / 'sbin'
 
         # If we have hadoop-addons (like lzo), set those in the environment
         hadoop_extra_classpath = []
         if 'lzo' in self.resources:
-            hadoop_extra_classpath.extend(hadoop_home.walkfiles('hadoop-lzo-*.jar'))
+            lzo_jars = kv.get('hadoop.lzo_jars')
+            if lzo_jars is None:  # installed by an older version of this library
+                lzo_jars = self._find_lzo_jars()
+            hadoop_extra_classpath.extend(lzo_jars)
+        hadoop_env_vars = {'JAVA_HOME': java_home}
+        if hadoop_extra_classpath:
+            hadoop_env_vars['HADOOP_EXTRA_CLASSPATH'] = ':'.join(hadoop_extra_classpath)
+        hadoop_env_vars.update({
+            'HADOOP_LIBEXEC_DIR': hadoop_home / 'libexec',
+            'HADOOP_INSTALL': hadoop_home,
+            'HADOOP_HOME': hadoop_home,
+            'HADOOP_COMMON_HOME': hadoop_home,
+            'HADOOP_HDFS_HOME': hadoop_home,
+            'HADOOP_MAPRED_HOME': hadoop_home,
+            'HADOOP_MAPRED_LOG_DIR': self.path('mapred_log_dir'),
+            'HADOOP_YARN_HOME': hadoop_home,
+            'HADOOP_CONF_DIR': self.path('hadoop_conf'),
+            'YARN_LOG_DIR': self.path('yarn_log_dir'),
+            'HADOOP_LOG_DIR': self.path('hdfs_log_dir'),
+        })
         with utils.environment_edit_in_place('/etc/environment') as env:
-            env['JAVA_HOME'] = java_home
-            if java_bin not in env['PATH']:
-                env['PATH'] = ':'.join([java_bin, env['PATH']])  # ensure that correct java is used
-            if hadoop_bin not in env['PATH']:
-                env['PATH'] = ':'.join([env['PATH'], hadoop_bin])
-            if hadoop_sbin not in env['PATH']:
-                env['PATH'] = ':'.join([env['PATH'], hadoop_sbin])
-            if hadoop_extra_classpath:
-                env['HADOOP_EXTRA_CLASSPATH'] = ':'.join(hadoop_extra_classpath)
-            env['HADOOP_LIBEXEC_DIR'] = hadoop_home / 'libexec'
-            env['HADOOP_INSTALL'] = hadoop_home
-            env['HADOOP_HOME'] = hadoop_home
-            env['HADOOP_COMMON_HOME'] = hadoop_home
-            env['HADOOP_HDFS_HOME'] = hadoop_home
-            env['HADOOP_MAPRED_HOME'] = hadoop_home
-            env['HADOOP_MAPRED_LOG_DIR'] = self.dist_config.path('mapred_log_dir')
-            env['HADOOP_YARN_HOME'] = hadoop_home
-            env['HADOOP_CONF_DIR'] = self.dist_config.path('hadoop_conf')
-            env['YARN_LOG_DIR'] = self.dist_config.path('yarn_log_dir')
-            env['HADOOP_LOG_DIR'] = self.dist_config.path('hdfs_log_dir')
-
-        hadoop_env = self.dist_config.path('hadoop_conf') / 'hadoop-env.sh'
+            env.update(hadoop_env_vars)
+            path = env['PATH'].split(':')
+            if java_bin not in path:
+                path.insert(0, str(java_bin))  # ensure that correct java is used
+            for bin_dir in (hadoop_bin, hadoop_sbin):
+                if bin_dir not in path:
+                    path.append(str(bin_dir))
+            env['PATH'] = ':'.join(path)
+
+        hadoop_env = self.path('hadoop_conf') / 'hadoop-env.sh'
         utils.re_edit_in_place(hadoop_env, {
             r'export JAVA_HOME *=.*': 'export JAVA_HOME=%s' % java_home,
         })
@@ -229,15 +318,18 @@ class HadoopBase(object):
 
         :param str relation: 'datanode' for registering HDFS slaves;
                              'nodemanager' for registering YARN slaves.
+        :returns: ``False`` if the slaves file was already up to date
         """
-        slaves_file = self.dist_config.path('hadoop_conf') / 'slaves'
-        slaves_file.write_lines(
-            [
-                '# DO NOT EDIT',
-                '# This file is automatically managed by Juju',
-            ] + slaves
-        )
+        slaves_file = self.path('hadoop_conf') / 'slaves'
+        content = ('\n'.join([
+            '# DO NOT EDIT',
+            '# This file is automatically managed by Juju',
+        ] + slaves) + '\n').encode('utf-8')
+        if slaves_file.exists() and slaves_file.bytes() == content:
+            return False
+        utils.atomic_write(slaves_file, content)
         slaves_file.chown('ubuntu', 'hadoop')
+        return True
 
     def run(self, user, command, *args, **kwargs):
         """
@@ -247,7 +339,7 @@ class HadoopBase(object):
         :param list args: Additional args to pass to the command
         """
         return utils.run_as(user,
-                            self.dist_config.path('hadoop') / command,
+                            self.path('hadoop') / command,
                             *args, **kwargs)
 
     def open_ports(self, service):
@@ -259,67 +351,151 @@ class HadoopBase(object):
             hookenv.close_port(port)
 
     def setup_init_script(self, user, servicename):
+        """
+        Install the upstart or systemd config for a Hadoop service, and
+        enable it under systemd.
+
+        :returns: ``False`` if the config was already up to date
+        """
         daemon = "yarn"
         if user == "hdfs":
             daemon = "hadoop"
         elif user == "mapred":
             daemon = "mr-jobhistory"
 
+        systemd = _init_is_systemd()
         template_name = 'templates/upstart.conf'
         target_template_path = '/etc/init/{}.conf'.format(servicename)
-        if host.init_is_systemd():
+        if systemd:
             template_name = 'templates/systemd.conf'
             target_template_path = '/etc/systemd/system/{}.service'.format(servicename)
 
-        d = os.path.dirname(sys.modules['jujubigdata'].__file__)
-        source_template_path = os.path.join(d, template_name)
-
+        context = dict(self._init_script_context, service=servicename, user=user, daemon=daemon)
+        content = _template_env.get_template(template_name).render(context).encode('utf-8')
+        changed = True
         if os.path.exists(target_template_path):
-            os.remove(target_template_path)
-
-        render(
-            source_template_path,
-            target_template_path,
-            templates_dir="/",
-            context={
-                'service': servicename,
-                'user': user,
-                'hadoop_path': self.dist_config.path('hadoop'),
-                'hadoop_conf': self.dist_config.path('hadoop_conf'),
-                'daemon': daemon,
-            },
-        )
-        if host.init_is_systemd():
+            with open(target_template_path, 'rb') as fp:
+                changed = fp.read() != content
+        if changed:
+            utils.atomic_write(target_template_path, content, perms=0o444)
+
+        if systemd:
+            # always enable, in case a previous hook failed before it got
+            # that far, or the unit has since been disabled
             utils.run_as('root', 'systemctl', 'enable', '{}.service'.format(servicename))
+            if changed:
+                utils.run_as('root', 'systemctl', 'daemon-reload')
+        return changed
 
-        if host.init_is_systemd():
-            utils.run_as('root', 'systemctl', 'daemon-reload')
 
+class HadoopDaemons(object):
+    """
+    Base class for the :class:`HDFS` and :class:`YARN` handlers.
+
+    Subclasses list their daemons in :attr:`daemons`, and the
+    :func:`daemon_methods` class decorator adds ``start_<daemon>``,
+    ``stop_<daemon>``, and ``restart_<daemon>`` methods for each of them,
+    all of which go through :meth:`control`.
+    """
+    #: Mapping of daemon name to a tuple of the init service name and the
+    #: Java class name that :func:`utils.jps` looks for (or ``None`` if the
+    #: daemon should not be checked for before starting it).
+    daemons = {}
 
-class HDFS(object):
     def __init__(self, hadoop_base):
         self.hadoop_base = hadoop_base
 
-    def stop_namenode(self):
-        host.service_stop('namenode')
-
-    def start_namenode(self):
-        if not utils.jps('NameNode'):
-            host.service_start('namenode')
-
-    def restart_namenode(self):
-        self.stop_namenode()
-        self.start_namenode()
+    def control(self, action, *daemons):
+        """
+        Start, stop, or restart one or more of the :attr:`daemons`.
 
-    def restart_zookeeper(self):
-        self.stop_zookeeper()
-        self.start_zookeeper()
+        Starting a daemon that is already running is a no-op, and a restart
+        waits (up to 30 seconds) for the daemon to exit before starting it.
+        When several daemons are given, they are handled concurrently.
 
-    def stop_zookeeper(self):
-        host.service_stop('zkfc')
+        :param str action: One of ``start``, ``stop``, or ``restart``
+        :param str daemons: Names of the daemons, e.g. ``namenode``
+        """
+        if action not in ('start', 'stop', 'restart'):
+            raise ValueError('Invalid daemon action: %s' % action)
+        if len(daemons) != 1:
+            if action == 'start':
+                # check them all against one process snapshot, before any of
+                # the threads start a daemon (which invalidates it)
+                utils.java_processes(refresh=True)
+                utils.parallel_map(self._start, [d for d in daemons if not self._running(d)])
+            else:
+                utils.parallel_map(lambda daemon: self.control(action, daemon), daemons)
+            return
+        daemon = daemons[0]
+        service, java_class = self.daemons[daemon]
+        if action in ('stop', 'restart'):
+            host.service_stop(service)
+            utils.clear_jps_cache()
+            if action == 'restart' and java_class:
+                utils.wait_until(lambda: not utils.jps(java_class))
+        if action in ('start', 'restart'):
+            if not self._running(daemon):
+                self._start(daemon)
+
+    def _running(self, daemon):
+        java_class = self.daemons[daemon][1]
+        return bool(java_class and utils.jps(java_class))
+
+    def _start(self, daemon):
+        host.service_start(self.daemons[daemon][0])
+        utils.clear_jps_cache()
+
+    def _refresh_nodes(self, kv_key, java_class, user, *command):
+        """
+        Have a running master re-read the slaves file, unless it has already
+        been told to since the file last changed.
 
-    def start_zookeeper(self):
-        host.service_start('zkfc')
+        Each refresh launches a JVM, so the digest of the slaves file as of
+        the last refresh is kept in the kv store under `kv_key`.
+        """
+        if not utils.jps(java_class):
+            return
+        slaves_file = self.hadoop_base.path('hadoop_conf') / 'slaves'
+        digest = hashlib.sha1(slaves_file.bytes() if slaves_file.exists() else b'').hexdigest()
+        kv = unitdata.kv()
+        if kv.get(kv_key) == digest:
+            return
+        self.hadoop_base.run(user, *command)
+        kv.set(kv_key, digest)
+        utils.flush_kv_on_exit()
+
+
+def daemon_methods(cls):
+    """
+    Class decorator that adds ``start_<daemon>``, ``stop_<daemon>``, and
+    ``restart_<daemon>`` methods for each of the class's
+    :attr:`~HadoopDaemons.daemons`, unless the class defines them itself.
+    """
+    def make_method(action, daemon):
+        def method(self):
+            self.control(action, daemon)
+        method.__name__ = '%s_%s' % (action, daemon)
+        method.__doc__ = '%s the %s daemon.' % (action.capitalize(), daemon)
+        return method
+
+    for daemon in cls.daemons:
+        for action in ('start', 'stop', 'restart'):
+            name = '%s_%s' % (action, daemon)
+            if name not in cls.__dict__:
+                setattr(cls, name, make_method(action, daemon))
+    return cls
+
+
+@daemon_methods
+class HDFS(HadoopDaemons):
+    daemons = {
+        'namenode': ('namenode', 'NameNode'),
+        'secondarynamenode': ('secondarynamenode', 'SecondaryNameNode'),
+        'datanode': ('datanode', 'DataNode'),
+        'journalnode': ('journalnode', 'JournalNode'),
+        'zookeeper': ('zkfc', None),
+    }
 
     def restart_dfs(self):
         self.stop_dfs()
@@ -327,60 +503,32 @@ class HDFS(object):
 
     def stop_dfs(self):
         self.hadoop_base.run('hdfs', 'sbin/stop-dfs.sh')
+        utils.clear_jps_cache()
 
     def start_dfs(self):
         self.hadoop_base.run('hdfs', 'sbin/start-dfs.sh')
-
-    def stop_secondarynamenode(self):
-        host.service_stop('secondarynamenode')
-
-    def start_secondarynamenode(self):
-        if not utils.jps('SecondaryNameNode'):
-            host.service_start('secondarynamenode')
-
-    def stop_datanode(self):
-        host.service_stop('datanode')
-
-    def start_datanode(self):
-        if not utils.jps('DataNode'):
-            host.service_start('datanode')
-
-    def restart_datanode(self):
-        self.stop_datanode()
-        self.start_datanode()
-
-    def stop_journalnode(self):
-        host.service_stop('journalnode')
-
-    def start_journalnode(self):
-        if not utils.jps('JournalNode'):
-            host.service_start('journalnode')
-
-    def restart_journalnode(self):
-        self.stop_journalnode()
-        self.start_journalnode()
+        utils.clear_jps_cache()
 
     def configure_namenode(self, namenodes):
-        dc = self.hadoop_base.dist_config
+        hb = self.hadoop_base
         clustername = hookenv.service_name()
         host = hookenv.local_unit().replace('/', '-')
-        self.configure_hdfs_base(clustername, namenodes, dc.port('namenode'), dc.port('nn_webapp_http'))
-        hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
-        with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
-            props['dfs.namenode.datanode.registration.ip-hostname-check'] = 'true'
-            props['dfs.namenode.http-address.%s.%s' % (clustername, host)] = '%s:%s' % (host, dc.port('nn_webapp_http'))
-            props['dfs.namenode.rpc-bind-host'] = '0.0.0.0'
-            props['dfs.namenode.servicerpc-bind-host'] = '0.0.0.0'
-            props['dfs.namenode.http-bind-host'] = '0.0.0.0'
-            props['dfs.namenode.https-bind-host'] = '0.0.0.0'
+        self.configure_hdfs_base(clustername, namenodes, hb.port('namenode'), hb.port('nn_webapp_http'), {
+            'dfs.namenode.datanode.registration.ip-hostname-check': 'true',
+            'dfs.namenode.http-address.%s.%s' % (clustername, host): '%s:%s' % (host, hb.port('nn_webapp_http')),
+            'dfs.namenode.rpc-bind-host': '0.0.0.0',
+            'dfs.namenode.servicerpc-bind-host': '0.0.0.0',
+            'dfs.namenode.http-bind-host': '0.0.0.0',
+            'dfs.namenode.https-bind-host': '0.0.0.0',
+        })
         self.hadoop_base.setup_init_script("hdfs", "namenode")
 
     def configure_zookeeper(self, zookeepers):
-        dc = self.hadoop_base.dist_config
-        hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
+        hb = self.hadoop_base
+        hdfs_site = hb.path('hadoop_conf') / 'hdfs-site.xml'
         with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
             props['dfs.ha.automatic-failover.enabled'] = 'true'
-        core_site = dc.path('hadoop_conf') / 'core-site.xml'
+        core_site = hb.path('hadoop_conf') / 'core-site.xml'
         with utils.xmlpropmap_edit_in_place(core_site) as props:
             zk_str = ','.join('{host}:{port}'.format(**zk) for zk in zookeepers)
             hookenv.log("Zookeeper string is: %s" % zk_str)
@@ -388,27 +536,31 @@ class HDFS(object):
         self.hadoop_base.setup_init_script("hdfs", "zkfc")
 
     def configure_datanode(self, clustername, namenodes, port, webhdfs_port):
-        self.configure_hdfs_base(clustername, namenodes, port, webhdfs_port)
-        dc = self.hadoop_base.dist_config
-        hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
-        with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
-            props['dfs.datanode.http.address'] = '0.0.0.0:{}'.format(dc.port('dn_webapp_http'))
+        self.configure_hdfs_base(clustername, namenodes, port, webhdfs_port, {
+            'dfs.datanode.http.address': '0.0.0.0:{}'.format(self.hadoop_base.port('dn_webapp_http')),
+        })
         self.hadoop_base.setup_init_script("hdfs", "datanode")
         self.hadoop_base.setup_init_script("hdfs", "journalnode")
 
     def configure_journalnode(self):
-        dc = self.hadoop_base.dist_config
-        hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
+        hb = self.hadoop_base
+        hdfs_site = hb.path('hadoop_conf') / 'hdfs-site.xml'
         with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
-            props['dfs.journalnode.rpc-address'] = '0.0.0.0:{}'.format(dc.port('journalnode'))
-            props['dfs.journalnode.http-address'] = '0.0.0.0:{}'.format(dc.port('jn_webapp_http'))
+            props['dfs.journalnode.rpc-address'] = '0.0.0.0:{}'.format(hb.port('journalnode'))
+            props['dfs.journalnode.http-address'] = '0.0.0.0:{}'.format(hb.port('jn_webapp_http'))
 
     def configure_client(self, clustername, namenodes, port, webhdfs_port):
         self.configure_hdfs_base(clustername, namenodes, port, webhdfs_port)
 
-    def configure_hdfs_base(self, clustername, namenodes, port, webhdfs_port):
-        dc = self.hadoop_base.dist_config
-        core_site = dc.path('hadoop_conf') / 'core-site.xml'
+    def configure_hdfs_base(self, clustername, namenodes, port, webhdfs_port, extra_hdfs_props=None):
+        """
+        Configure the core-site.xml and hdfs-site.xml common to all HDFS units.
+
+        :param dict extra_hdfs_props: Additional hdfs-site.xml properties to set
+            in the same edit, so that the file is only rewritten once.
+        """
+        hb = self.hadoop_base
+        core_site = hb.path('hadoop_conf') / 'core-site.xml'
         with utils.xmlpropmap_edit_in_place(core_site) as props:
             props['hadoop.proxyuser.hue.hosts'] = "*"
             props['hadoop.proxyuser.hue.groups'] = "*"
@@ -428,11 +580,11 @@ class HDFS(object):
                                                   'org.apache.hadoop.io.compress.BZip2Codec, '
                                                   'org.apache.hadoop.io.compress.SnappyCodec')
             props['fs.defaultFS'] = "hdfs://{clustername}".format(clustername=clustername, port=port)
-        hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
+        hdfs_site = hb.path('hadoop_conf') / 'hdfs-site.xml'
         with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
             props['dfs.webhdfs.enabled'] = "true"
-            props['dfs.namenode.name.dir'] = dc.path('hdfs_dir_base') / 'cache/hadoop/dfs/name'
-            props['dfs.datanode.data.dir'] = dc.path('hdfs_dir_base') / 'cache/hadoop/dfs/name'
+            props['dfs.namenode.name.dir'] = hb.path('hdfs_dir_base') / 'cache/hadoop/dfs/name'
+            props['dfs.datanode.data.dir'] = hb.path('hdfs_dir_base') / 'cache/hadoop/dfs/name'
             props['dfs.permissions'] = 'false'  # TODO - secure this hadoop installation!
             props['dfs.nameservices'] = clustername
             props['dfs.client.failover.proxy.provider.%s' % clustername] = \
@@ -440,9 +592,14 @@ class HDFS(object):
             props['dfs.ha.fencing.methods'] = 'sshfence\nshell(/bin/true)'
             props['dfs.ha.fencing.ssh.private-key-files'] = utils.ssh_priv_key('hdfs')
             props['dfs.ha.namenodes.%s' % clustername] = ','.join(namenodes)
+            rpc_prefix = 'dfs.namenode.rpc-address.%s.' % clustername
+            http_prefix = 'dfs.namenode.http-address.%s.' % clustername
+            nn_addrs = {}
             for node in namenodes:
-                props['dfs.namenode.rpc-address.%s.%s' % (clustername, node)] = '%s:%s' % (node, port)
-                props['dfs.namenode.http-address.%s.%s' % (clustername, node)] = '%s:%s' % (node, webhdfs_port)
+                nn_addrs[rpc_prefix + node] = '%s:%s' % (node, port)
+                nn_addrs[http_prefix + node] = '%s:%s' % (node, webhdfs_port)
+            props.update(nn_addrs)
+            props.update(extra_hdfs_props or {})
 
     def init_sharededits(self):
         self._hdfs('namenode', '-initializeSharedEdits', '-nonInteractive', '-force')
@@ -467,57 +624,63 @@ class HDFS(object):
         hookenv.log(str(namenodes) + ", " + str(leader))
         hookenv.log(str(len(namenodes)))
         if len(namenodes) == 2:
-            output = []
-            for node in namenodes:
-                output.append(utils.run_as('hdfs',
-                                           'hdfs', 'haadmin', '-getServiceState', '{}'.format(node),
-                                           capture_output=True).lower())
+            # each probe launches a JVM, so query both namenodes at once
+            output = utils.parallel_map(
+                lambda node: utils.run_as('hdfs',
+                                          'hdfs', 'haadmin', '-getServiceState', '{}'.format(node),
+                                          capture_output=True).lower(),
+                namenodes)
             if 'active' not in output:
                 self.transition_to_active(leader)
 
     def format_namenode(self):
-        if unitdata.kv().get('hdfs.namenode.formatted'):
+        kv = unitdata.kv()
+        if kv.get('hdfs.namenode.formatted'):
             return
         self.stop_namenode()
         # Run without prompting; this will fail if the namenode has already
         # been formatted -- we do not want to reformat existing data!
         clusterid = hookenv.service_name()
         self._hdfs('namenode', '-format', '-noninteractive', '-clusterid', clusterid)
-        unitdata.kv().set('hdfs.namenode.formatted', True)
-        unitdata.kv().flush(True)
+        kv.set('hdfs.namenode.formatted', True)
+        kv.flush(True)  # never risk reformatting, so commit this right away
 
     def create_hdfs_dirs(self):
-        if unitdata.kv().get('hdfs.namenode.dirs.created'):
+        kv = unitdata.kv()
+        if kv.get('hdfs.namenode.dirs.created'):
             return
         hookenv.log("Creating HDFS Data dirs...")
-        self._hdfs('dfs', '-mkdir', '-p', '/tmp/hadoop/mapred/staging')
-        self._hdfs('dfs', '-chmod', '-R', '1777', '/tmp/hadoop/mapred/staging')
-        self._hdfs('dfs', '-mkdir', '-p', '/tmp/hadoop-yarn/staging')
-        self._hdfs('dfs', '-chmod', '-R', '1777', '/tmp/hadoop-yarn')
-        self._hdfs('dfs', '-mkdir', '-p', '/user/ubuntu')
+        # Each hdfs command spins up a JVM, so group the operations by
+        # command (and mode / owner) rather than issuing one per directory.
+        self._hdfs('dfs', '-mkdir', '-p',
+                   '/tmp/hadoop/mapred/staging',
+                   '/tmp/hadoop-yarn/staging',
+                   '/user/ubuntu',
+                   '/mr-history/tmp',  # for JobHistory
+                   '/mr-history/done',
+                   '/app-logs')
+        self._hdfs('dfs', '-chmod', '-R', '1777',
+                   '/tmp/hadoop/mapred/staging',
+                   '/tmp/hadoop-yarn',
+                   '/mr-history/tmp',
+                   '/mr-history/done',
+                   '/app-logs')
         self._hdfs('dfs', '-chown', '-R', 'ubuntu', '/user/ubuntu')
-        # for JobHistory
-        self._hdfs('dfs', '-mkdir', '-p', '/mr-history/tmp')
-        self._hdfs('dfs', '-chmod', '-R', '1777', '/mr-history/tmp')
-        self._hdfs('dfs', '-mkdir', '-p', '/mr-history/done')
-        self._hdfs('dfs', '-chmod', '-R', '1777', '/mr-history/done')
         self._hdfs('dfs', '-chown', '-R', 'mapred:hdfs', '/mr-history')
-        self._hdfs('dfs', '-mkdir', '-p', '/app-logs')
-        self._hdfs('dfs', '-chmod', '-R', '1777', '/app-logs')
         self._hdfs('dfs', '-chown', 'yarn', '/app-logs')
-        unitdata.kv().set('hdfs.namenode.dirs.created', True)
-        unitdata.kv().flush(True)
+        kv.set('hdfs.namenode.dirs.created', True)
+        utils.flush_kv_on_exit()
 
     def register_slaves(self, slaves):
         self.hadoop_base.register_slaves(slaves)
 
     def reload_slaves(self):
-        if utils.jps('NameNode'):
-            self.hadoop_base.run('hdfs', 'bin/hdfs', 'dfsadmin', '-refreshNodes')
+        self._refresh_nodes('hdfs.slaves.refreshed', 'NameNode',
+                            'hdfs', 'bin/hdfs', 'dfsadmin', '-refreshNodes')
 
     def register_journalnodes(self, nodes, port):
         clustername = hookenv.service_name()
-        hdfs_site = self.hadoop_base.dist_config.path('hadoop_conf') / 'hdfs-site.xml'
+        hdfs_site = self.hadoop_base.path('hadoop_conf') / 'hdfs-site.xml'
         with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
             props['dfs.namenode.shared.edits.dir'] = 'qjournal://{}/{}'.format(
                 ';'.join(['%s:%s' % (host, port) for host in nodes]),
@@ -527,38 +690,13 @@ class HDFS(object):
         self.hadoop_base.run('hdfs', 'bin/hdfs', command, *args)
 
 
-class YARN(object):
-    def __init__(self, hadoop_base):
-        self.hadoop_base = hadoop_base
-
-    def stop_resourcemanager(self):
-        host.service_stop('resourcemanager')
-
-    def start_resourcemanager(self):
-        if not utils.jps('ResourceManager'):
-            host.service_start('resourcemanager')
-
-    def restart_resourcemanager(self):
-        self.stop_resourcemanager()
-        self.start_resourcemanager()
-
-    def stop_jobhistory(self):
-        host.service_stop('historyserver')
-
-    def start_jobhistory(self):
-        if not utils.jps('JobHistoryServer'):
-            host.service_start('historyserver')
-
-    def stop_nodemanager(self):
-        host.service_stop('nodemanager')
-
-    def start_nodemanager(self):
-        if not utils.jps('NodeManager'):
-            host.service_start('nodemanager')
-
-    def restart_nodemanager(self):
-        self.stop_nodemanager()
-        self.start_nodemanager()
+@daemon_methods
+class YARN(HadoopDaemons):
+    daemons = {
+        'resourcemanager': ('resourcemanager', 'ResourceManager'),
+        'jobhistory': ('historyserver', 'JobHistoryServer'),
+        'nodemanager': ('nodemanager', 'NodeManager'),
+    }
 
     def _local(self):
         """
@@ -566,32 +704,28 @@ class YARN(object):
         and resourcemanager port from our dist.yaml
         """
         host = hookenv.local_unit().replace('/', '-')
-        port = self.hadoop_base.dist_config.port('resourcemanager')
-        history_http = self.hadoop_base.dist_config.port('jh_webapp_http')
-        history_ipc = self.hadoop_base.dist_config.port('jobhistory')
+        port = self.hadoop_base.port('resourcemanager')
+        history_http = self.hadoop_base.port('jh_webapp_http')
+        history_ipc = self.hadoop_base.port('jobhistory')
         return host, port, history_http, history_ipc
 
     def configure_resourcemanager(self):
-        self.configure_yarn_base(*self._local())
-        dc = self.hadoop_base.dist_config
-        yarn_site = dc.path('hadoop_conf') / 'yarn-site.xml'
-        with utils.xmlpropmap_edit_in_place(yarn_site) as props:
+        hb = self.hadoop_base
+        self.configure_yarn_base(*self._local(), extra_yarn_props={
             # 0.0.0.0 will listen on all interfaces, which is what we want on the server
-            props['yarn.resourcemanager.webapp.address'] = '0.0.0.0:{}'.format(dc.port('rm_webapp_http'))
+            'yarn.resourcemanager.webapp.address': '0.0.0.0:{}'.format(hb.port('rm_webapp_http')),
             # TODO: support SSL
-            # props['yarn.resourcemanager.webapp.https.address'] = '0.0.0.0:{}'.format(dc.port('rm_webapp_https'))
+            # 'yarn.resourcemanager.webapp.https.address': '0.0.0.0:{}'.format(hb.port('rm_webapp_https')),
+        })
         self.hadoop_base.setup_init_script(user='yarn', servicename='resourcemanager')
 
     def configure_jobhistory(self):
-        self.configure_yarn_base(*self._local())
-        dc = self.hadoop_base.dist_config
-        mapred_site = dc.path('hadoop_conf') / 'mapred-site.xml'
-        with utils.xmlpropmap_edit_in_place(mapred_site) as props:
+        hb = self.hadoop_base
+        self.configure_yarn_base(*self._local(), extra_mapred_props={
             # 0.0.0.0 will listen on all interfaces, which is what we want on the server
-            props["mapreduce.jobhistory.address"] = "0.0.0.0:{}".format(dc.port('jobhistory'))
-            props["mapreduce.jobhistory.webapp.address"] = "0.0.0.0:{}".format(dc.port('jh_webapp_http'))
-            props["mapreduce.jobhistory.intermediate-done-dir"] = "/mr-history/tmp"
-            props["mapreduce.jobhistory.done-dir"] = "/mr-history/done"
+            "mapreduce.jobhistory.address": "0.0.0.0:{}".format(hb.port('jobhistory')),
+            "mapreduce.jobhistory.webapp.address": "0.0.0.0:{}".format(hb.port('jh_webapp_http')),
+        })
         self.hadoop_base.setup_init_script(user='mapred', servicename='historyserver')
 
     def configure_nodemanager(self, host, port, history_http, history_ipc):
@@ -601,9 +735,18 @@ class YARN(object):
     def configure_client(self, host, port, history_http, history_ipc):
         self.configure_yarn_base(host, port, history_http, history_ipc)
 
-    def configure_yarn_base(self, host, port, history_http, history_ipc):
-        dc = self.hadoop_base.dist_config
-        yarn_site = dc.path('hadoop_conf') / 'yarn-site.xml'
+    def configure_yarn_base(self, host, port, history_http, history_ipc,
+                            extra_yarn_props=None, extra_mapred_props=None):
+        """
+        Configure the yarn-site.xml and mapred-site.xml common to all YARN units.
+
+        :param dict extra_yarn_props: Additional yarn-site.xml properties to set
+            in the same edit, so that the file is only rewritten once.
+        :param dict extra_mapred_props: Additional mapred-site.xml properties to
+            set in the same edit, so that the file is only rewritten once.
+        """
+        hb = self.hadoop_base
+        yarn_site = hb.path('hadoop_conf') / 'yarn-site.xml'
         with utils.xmlpropmap_edit_in_place(yarn_site) as props:
             props['yarn.nodemanager.aux-services'] = 'mapreduce_shuffle'
             props['yarn.nodemanager.vmem-check-enabled'] = 'false'
@@ -611,7 +754,8 @@ class YARN(object):
                 props['yarn.resourcemanager.hostname'] = '{}'.format(host)
                 props['yarn.resourcemanager.address'] = '{}:{}'.format(host, port)
                 props["yarn.log.server.url"] = "{}:{}/jobhistory/logs/".format(host, history_http)
-        mapred_site = dc.path('hadoop_conf') / 'mapred-site.xml'
+            props.update(extra_yarn_props or {})
+        mapred_site = hb.path('hadoop_conf') / 'mapred-site.xml'
         with utils.xmlpropmap_edit_in_place(mapred_site) as props:
             if host and history_ipc:
                 props["mapreduce.jobhistory.address"] = "{}:{}".format(host, history_ipc)
@@ -625,6 +769,7 @@ class YARN(object):
             props["mapreduce.application.classpath"] = "$HADOOP_HOME/share/hadoop/mapreduce/*,\
                 $HADOOP_HOME/share/hadoop/mapreduce/lib/*,\
                 $HADOOP_HOME/share/hadoop/tools/lib/*"
+            props.update(extra_mapred_props or {})
 
     def install_demo(self):
         if unitdata.kv().get('yarn.client.demo.installed'):
@@ -637,9 +782,9 @@ class YARN(object):
         Path(demo_target).chmod(0o755)
         Path(demo_target).chown('ubuntu', 'hadoop')
         unitdata.kv().set('yarn.client.demo.installed', True)
-        unitdata.kv().flush(True)
+        utils.flush_kv_on_exit()
 
     def register_slaves(self, slaves):
         self.hadoop_base.register_slaves(slaves)
-        if utils.jps('ResourceManager'):
-            self.hadoop_base.run('mapred', 'bin/yarn', 'rmadmin', '-refreshNodes')
+        self._refresh_nodes('yarn.slaves.refreshed', 'ResourceManager',
+                            'mapred', 'bin/yarn', 'rmadmin', '-refreshNodes')
@@ -13,12 +13,59 @@
 import pwd
 import json
 
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # optional; much faster than json when available
+
 from charmhelpers.core import hookenv
 from charmhelpers.core.charmframework.helpers import Relation, any_ready_unit
 
 from jujubigdata import utils
 
 
+def _dumps(obj):
+    """
+    Serialize `obj` to a JSON string for relation data, using orjson if it
+    is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+
+def _loads(data):
+    """
+    Deserialize a JSON string from relation data, using orjson if it is
+    installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# parsed remote specs, keyed by their JSON; every unit of a service
+# normally sends the same spec
+_remote_spec_cache = {}
+_REMOTE_SPEC_CACHE_SIZE = 128
+
+
+def _parse_spec(spec_json):
+    """
+    Parse a remote unit's ``spec`` JSON, reusing the result for a value that
+    has been seen before.  The returned dict is shared, so must not be modified.
+    """
+    spec_json = spec_json or '{}'
+    spec = _remote_spec_cache.get(spec_json)
+    if spec is None:
+        if len(_remote_spec_cache) >= _REMOTE_SPEC_CACHE_SIZE:
+            _remote_spec_cache.clear()
+        spec = _remote_spec_cache[spec_json] = _loads(spec_json)
+    return spec
+
+
 class SpecMatchingRelation(Relation):
     """
     Relation base class that validates that a version and environment
@@ -52,6 +99,10 @@ class SpecMatchingRelation(Relation):
         """
         super(SpecMatchingRelation, self).__init__(*args, **kwargs)
         self._spec = spec
+        self._spec_copy = None
+        self._spec_json = None
+        if spec and not callable(spec):
+            self._require_spec()
 
     @property
     def spec(self):
@@ -59,21 +110,40 @@ class SpecMatchingRelation(Relation):
             return self._spec()
         return self._spec
 
+    def spec_json(self):
+        """
+        The local ``spec``, serialized as JSON (or ``None`` if there is no spec).
+
+        The serialized form is reused for as long as the spec is unchanged.
+        """
+        spec = self.spec
+        if not spec:
+            return None
+        if self._spec_json is None or spec != self._spec_copy:
+            self._spec_copy = dict(spec)
+            self._spec_json = _dumps(spec)
+        return self._spec_json
+
     def provide(self, remote_service, all_ready):
         """
         Provide the ``spec`` data to the remote service.
 
         Subclasses *must* either delegate to this method (e.g., via `super()`)
-        or include ``'spec': json.dumps(self.spec)`` in the provided data themselves.
+        or include ``'spec': self.spec_json()`` in the provided data themselves.
         """
         data = super(SpecMatchingRelation, self).provide(remote_service, all_ready)
-        if self.spec:
-            data['spec'] = json.dumps(self.spec)
+        spec_json = self.spec_json()
+        if spec_json:
+            data['spec'] = spec_json
         return data
 
+    def _require_spec(self):
+        # rebind rather than append, so a class-level list isn't modified
+        self.required_keys = list(self.required_keys) + ['spec']
+
     def filtered_data(self, remote_service=None):
-        if self.spec and 'spec' not in self.required_keys:
-            self.required_keys.append('spec')
+        if 'spec' not in self.required_keys and self.spec:
+            self._require_spec()  # a callable spec may only now be available
         return super(SpecMatchingRelation, self).filtered_data(remote_service)
 
     def is_ready(self):
@@ -83,17 +153,21 @@ class SpecMatchingRelation(Relation):
         """
         if not super(SpecMatchingRelation, self).is_ready():
             return False
-        if not self.spec:
+        spec = self.spec
+        if not spec:
             return True
-        for unit, data in self.filtered_data().items():
-            remote_spec = json.loads(data.get('spec', '{}'))
-            for k, v in self.spec.items():
-                if v != remote_spec.get(k):
-                    # TODO XXX Once extended status reporting is available,
-                    #          we should use that instead of erroring.
-                    raise ValueError(
-                        'Spec mismatch with related unit %s: '
-                        '%r != %r' % (unit, data.get('spec'), json.dumps(self.spec)))
+        spec_items = six.viewitems(spec)
+        # in the common case every unit matches and this list is empty
+        suspects = [(unit, data) for unit, data in self.filtered_data().items()
+                    if not spec_items <= six.viewitems(_parse_spec(data.get('spec')))]
+        for unit, data in suspects:
+            remote_spec = _parse_spec(data.get('spec'))
+            if any(v != remote_spec.get(k) for k, v in spec_items):
+                # TODO XXX Once extended status reporting is available,
+                #          we should use that instead of erroring.
+                raise ValueError(
+                    'Spec mismatch with related unit %s: '
+                    '%r != %r' % (unit, data.get('spec'), self.spec_json()))
         return True
 
 
@@ -104,6 +178,7 @@ class SSHRelation(Relation):
         super(SSHRelation, self).__init__(*args, **kwargs)
         if 'ssh-key' not in self.required_keys:
             self.required_keys = self.required_keys + ['ssh-key']
+        self._ssh_key = None
 
     def install_ssh_keys(self):
         unit, data = any_ready_unit(self.relation_name)
@@ -117,9 +192,10 @@ class SSHRelation(Relation):
         except KeyError:
             hookenv.log('Cannot provide SSH key yet, user not available: %s' % self.ssh_user)
         else:
-            data.update({
-                'ssh-key': utils.get_ssh_key(self.ssh_user),
-            })
+            if self._ssh_key is None:
+                # the key never changes once generated, so only read it once
+                self._ssh_key = utils.get_ssh_key(self.ssh_user)
+            data['ssh-key'] = self._ssh_key
         return data
 
 
@@ -131,9 +207,7 @@ class EtcHostsRelation(Relation):
 
     def provide(self, remote_service, all_ready):
         data = super(EtcHostsRelation, self).provide(remote_service, all_ready)
-        data.update({
-            'etc_hosts': json.dumps(utils.get_kv_hosts()),
-        })
+        data['etc_hosts'] = _dumps(utils.get_kv_hosts())
         return data
 
     def register_connected_hosts(self):
@@ -144,7 +218,7 @@ class EtcHostsRelation(Relation):
 
     def register_provided_hosts(self):
         unit, data = any_ready_unit(self.relation_name)
-        provided_hosts = json.loads(data['etc_hosts'])
+        provided_hosts = _loads(data['etc_hosts'])
         hookenv.log('Registering hosts from %s: %s' % (unit, provided_hosts))
         for ip, name in provided_hosts.items():
             utils.update_kv_host(ip, name)
@@ -153,7 +227,7 @@ class EtcHostsRelation(Relation):
         my_ip = utils.resolve_private_address(hookenv.unit_get('private-address'))
         my_hostname = hookenv.local_unit().replace('/', '-')
         unit, data = any_ready_unit(self.relation_name)
-        etc_hosts = json.loads((data or {}).get('etc_hosts', '{}'))
+        etc_hosts = _loads((data or {}).get('etc_hosts') or '{}')
         return etc_hosts.get(my_ip, None) == my_hostname
 
 
@@ -170,17 +244,19 @@ class NameNode(SpecMatchingRelation, EtcHostsRelation):
     def __init__(self, spec=None, port=None, webhdfs_port=None, *args, **kwargs):
         self.port = port  # only needed for provides
         self.webhdfs_port = webhdfs_port  # only needed for provides
+        self._datanodes_ready = None
         utils.initialize_kv_host()
         super(NameNode, self).__init__(spec, *args, **kwargs)
 
     def provide(self, remote_service, all_ready):
         data = super(NameNode, self).provide(remote_service, all_ready)
         if all_ready and utils.wait_for_jps('NameNode', 300):
-            data.update({
-                'has_slave': DataNode().is_ready(),
-                'port': self.port,
-                'webhdfs-port': self.webhdfs_port,
-            })
+            if self._datanodes_ready is None:
+                # the same for every remote service, so only check once
+                self._datanodes_ready = DataNode().is_ready()
+            data['has_slave'] = self._datanodes_ready
+            data['port'] = self.port
+            data['webhdfs-port'] = self.webhdfs_port
         return data
 
     def has_slave(self):
@@ -226,18 +302,20 @@ class ResourceManager(SpecMatchingRelation, EtcHostsRelation):
         self.port = port  # only needed for provides
         self.historyserver_http = historyserver_http  # only needed for provides
         self.historyserver_ipc = historyserver_ipc    # only needed for provides
+        self._nodemanagers_ready = None
         utils.initialize_kv_host()
         super(ResourceManager, self).__init__(spec, *args, **kwargs)
 
     def provide(self, remote_service, all_ready):
         data = super(ResourceManager, self).provide(remote_service, all_ready)
         if all_ready and utils.wait_for_jps('ResourceManager', 300):
-            data.update({
-                'has_slave': NodeManager().is_ready(),
-                'port': self.port,
-                'historyserver-http': self.historyserver_http,
-                'historyserver-ipc': self.historyserver_ipc,
-            })
+            if self._nodemanagers_ready is None:
+                # the same for every remote service, so only check once
+                self._nodemanagers_ready = NodeManager().is_ready()
+            data['has_slave'] = self._nodemanagers_ready
+            data['port'] = self.port
+            data['historyserver-http'] = self.historyserver_http
+            data['historyserver-ipc'] = self.historyserver_ipc
         return data
 
     def has_slave(self):
@@ -276,9 +354,7 @@ class DataNode(SpecMatchingRelation):
     def provide(self, remote_service, all_ready):
         data = super(DataNode, self).provide(remote_service, all_ready)
         hostname = hookenv.local_unit().replace('/', '-')
-        data.update({
-            'hostname': hostname,
-        })
+        data['hostname'] = hostname
         return data
 
 
@@ -296,10 +372,8 @@ class SecondaryNameNode(SpecMatchingRelation):
     def provide(self, remote_service, all_ready):
         data = super(SecondaryNameNode, self).provide(remote_service, all_ready)
         hostname = hookenv.local_unit().replace('/', '-')
-        data.update({
-            'hostname': hostname,
-            'port': self.port,
-        })
+        data['hostname'] = hostname
+        data['port'] = self.port
         return data
 
 
@@ -313,9 +387,7 @@ class NodeManager(Relation):
     def provide(self, remote_service, all_ready):
         data = super(NodeManager, self).provide(remote_service, all_ready)
         hostname = hookenv.local_unit().replace('/', '-')
-        data.update({
-            'hostname': hostname,
-        })
+        data['hostname'] = hostname
         return data
 
 
@@ -345,21 +417,25 @@ class HadoopPlugin(Relation):
     def __init__(self, hdfs_only=False, *args, **kwargs):
         if hdfs_only:
             self.required_keys = ['hdfs-ready']
+        self._provided = None
         super(HadoopPlugin, self).__init__(*args, **kwargs)
 
     def provide(self, remote_service, all_ready):
         """
         Used by the endpoint to provide the :attr:`required_keys`.
         """
-        hdfs_ready = NameNode().is_ready()
-        yarn_ready = ResourceManager().is_ready()
-        if hdfs_ready:
-            # make sure we can actually reach HDFS
-            utils.wait_for_hdfs(300)  # will error if timeout
-        return {
-            'hdfs-ready': utils.normalize_strbool(hdfs_ready),
-            'yarn-ready': utils.normalize_strbool(yarn_ready),
-        }
+        if self._provided is None:
+            # the same for every remote service, so only check (and wait) once
+            hdfs_ready = NameNode().is_ready()
+            yarn_ready = ResourceManager().is_ready()
+            if hdfs_ready:
+                # make sure we can actually reach HDFS
+                utils.wait_for_hdfs(300)  # will error if timeout
+            self._provided = {
+                'hdfs-ready': utils.normalize_strbool(hdfs_ready),
+                'yarn-ready': utils.normalize_strbool(yarn_ready),
+            }
+        return dict(self._provided)
 
     def is_ready(self):
         if not super(HadoopPlugin, self).is_ready():
@@ -518,10 +594,8 @@ class FlumeAgent(Relation):
             hookenv.log('Invalid flume protocol {}'.format(flume_protocol), hookenv.ERROR)
             return data
         if all_ready:
-            data.update({
-                'port': self.port,
-                'protocol': hookenv.config('protocol'),
-            })
+            data['port'] = self.port
+            data['protocol'] = hookenv.config('protocol')
         return data
 
 
@@ -537,10 +611,8 @@ class HBase(SSHRelation):
     def provide(self, remote_service, all_ready):
         data = super(HBase, self).provide(remote_service, all_ready)
         if all_ready:
-            data.update({
-                'master-port': self.master_port,
-                'region-port': self.region_port,
-            })
+            data['master-port'] = self.master_port
+            data['region-port'] = self.region_port
         return data
 
 
@@ -555,10 +627,8 @@ class Hive(Relation):
     def provide(self, remote_service, all_ready):
         data = super(Hive, self).provide(remote_service, all_ready)
         if all_ready:
-            data.update({
-                'ready': 'true',
-                'port': self.port,
-            })
+            data['ready'] = 'true'
+            data['port'] = self.port
         return data
 
 
@@ -573,9 +643,7 @@ class Kafka(Relation):
     def provide(self, remote_service, all_ready):
         data = super(Kafka, self).provide(remote_service, all_ready)
         if all_ready:
-            data.update({
-                'port': self.port,
-            })
+            data['port'] = self.port
         return data
 
 
@@ -586,9 +654,7 @@ class Spark(Relation):
     def provide(self, remote_service, all_ready):
         data = super(Spark, self).provide(remote_service, all_ready)
         if all_ready:
-            data.update({
-                'ready': 'true',
-            })
+            data['ready'] = 'true'
         return data
 
 
@@ -603,9 +669,7 @@ class Zookeeper(Relation):
     def provide(self, remote_service, all_ready):
         data = super(Zookeeper, self).provide(remote_service, all_ready)
         if all_ready:
-            data.update({
-                'port': self.port,
-            })
+            data['port'] = self.port
         return data
 
 
@@ -10,19 +10,29 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # Apache License for more details.
 
+import io
 import os
 import re
+import copy
+import atexit
 import time
+import six
 import yaml
 import socket
+import stat
 import subprocess
+import sys
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from subprocess import check_call, check_output, CalledProcessError, Popen
-from xml.etree import ElementTree as ET
+try:
+    from xml.etree import cElementTree as ET  # C implementation on Python 2
+except ImportError:
+    from xml.etree import ElementTree as ET
 from xml.dom import minidom
 from distutils.util import strtobool as _strtobool
 from path import Path
-from tempfile import NamedTemporaryFile
+from tempfile import mkstemp
 
 from charmhelpers.core import unitdata
 from charmhelpers.core import hookenv
@@ -30,6 +40,38 @@ from charmhelpers.core import host
 from charmhelpers import fetch
 
 
+def _file_stamp(st):
+    """
+    Return a key identifying the version of a file from its `os.stat` result,
+    for deciding whether a cached parse of it is still valid.
+
+    The inode is included because files are replaced by renaming a new copy
+    into place (see :func:`atomic_write`), which may leave the mtime and
+    size unchanged.
+    """
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+# use the libyaml-backed loader when PyYAML was built with it
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_dist_yaml_cache = {}
+
+
+def _load_dist_yaml(filename):
+    """
+    Parse a dist.yaml file, reusing the previous result for as long as the
+    file is unchanged.  Each caller gets its own copy of the data.
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = _file_stamp(st)
+    cached = _dist_yaml_cache.get(filename)
+    if cached is None or cached[0] != stamp:
+        with open(filename, 'rb') as fp:
+            cached = _dist_yaml_cache[filename] = (stamp, yaml.load(fp, Loader=_YamlLoader))
+    return copy.deepcopy(cached[1])
+
+
 class DistConfig(object):
     """
     This class processes distribution-specific configuration options.
@@ -81,7 +123,7 @@ class DistConfig(object):
     def __init__(self, filename='dist.yaml', required_keys=None, data=None):
         if data is None:
             self.yaml_file = filename
-            self.dist_config = yaml.load(Path(self.yaml_file).text())
+            self.dist_config = _load_dist_yaml(filename)
 
             # validate dist.yaml
             missing_keys = set(required_keys or []) - set(self.dist_config.keys())
@@ -96,10 +138,16 @@ class DistConfig(object):
 
         self.groups = []
         self.users = {}
+        self._path_cache = {}
         for opt in self.dist_config.keys():
             setattr(self, opt, self.dist_config[opt])
 
     def path(self, key):
+        if key not in self._path_cache:
+            self._path_cache[key] = self._resolve_path(key)
+        return self._path_cache[key]
+
+    def _resolve_path(self, key):
         config = hookenv.config()
         dirs = {name: self.dirs[name]['path'] for name in self.dirs.keys()}
         levels = 0
@@ -184,26 +232,145 @@ def disable_firewall():
             check_call(['ufw', 'enable'])
 
 
+def _combine_patterns(compiled):
+    """
+    Join compiled patterns into a single alternation, which matches a line if
+    any of them do, so lines that none of them match can be skipped with a
+    single scan.
+
+    Returns None if the patterns can't be safely combined (e.g., because
+    they use groups or inline flags, whose meaning would change).
+    """
+    if len(compiled) < 2:
+        return None
+    if any(regex.groups or regex.flags & ~re.UNICODE for pat, regex, repl in compiled):
+        return None
+    try:
+        return re.compile('|'.join('(?:%s)' % pat for pat, regex, repl in compiled))
+    except re.error:
+        return None
+
+
+def re_editor(subs, encoding='utf8', append_non_matches=False):
+    """
+    Prepare a set of in-place edits, returning a function which applies
+    them to a given file.
+
+    The patterns are compiled once, up front, so this is cheaper than
+    calling :func:`re_edit_in_place` repeatedly with the same edits.
+
+    Example usage::
+
+        edit = re_editor({r'^JAVA_HOME=.*': 'JAVA_HOME=/usr/lib/jvm/default'})
+        for filename in env_files:
+            edit(filename)
+
+    :param dict subs: Mapping of patterns to replacement strings
+    """
+    compiled = [(pat, re.compile(pat), repl) for pat, repl in subs.items()]
+    combined = _combine_patterns(compiled)
+
+    def edit(filename):
+        matches = set()
+        # only newlines separate lines, as when iterating over the file
+        # (str.splitlines would also split on form feeds, U+2028, etc.)
+        with io.open(filename, encoding=encoding) as fp:
+            old_contents = fp.read()
+        new_lines = []
+        for line in io.StringIO(old_contents):
+            if combined is None or combined.search(line):
+                for pat, regex, repl in compiled:
+                    line, count = regex.subn(repl, line)
+                    if count:
+                        matches.add(pat)
+            new_lines.append(line)
+        if append_non_matches:
+            if new_lines and not new_lines[-1].endswith('\n'):
+                new_lines.append('\n')
+            for pat, regex, repl in compiled:
+                if pat not in matches:
+                    new_lines.append('%s\n' % repl)
+        new_contents = ''.join(new_lines)
+        if new_contents != old_contents:
+            atomic_write(filename, new_contents, encoding=encoding)
+    return edit
+
+
 def re_edit_in_place(filename, subs, encoding='utf8', append_non_matches=False):
     """
     Perform a set of in-place edits to a file.
 
+    The file is only rewritten if the edits changed it, and is then replaced
+    atomically.
+
     :param str filename: Name of file to edit
     :param dict subs: Mapping of patterns to replacement strings
     """
-    matches = set()
-    with Path(filename).in_place(encoding=encoding) as (reader, writer):
-        for line in reader:
-            for pat, repl in subs.items():
-                if re.search(pat, line):
-                    matches.add(pat)
-                    line = re.sub(pat, repl, line)
-            writer.write(line)
-        if append_non_matches:
-            if not line.endswith('\n'):
-                writer.write('\n')
-            for pat in set(subs.keys()) - matches:
-                writer.write('%s\n' % subs[pat])
+    re_editor(subs, encoding, append_non_matches)(filename)
+
+
+def re_edit_in_place_many(filenames, subs, encoding='utf8', append_non_matches=False):
+    """
+    Perform the same set of in-place edits to several files, as with
+    :func:`re_edit_in_place`.
+
+    The patterns are compiled once, and the files are edited concurrently.
+
+    :param list filenames: Names of files to edit
+    :param dict subs: Mapping of patterns to replacement strings
+    """
+    parallel_map(re_editor(subs, encoding, append_non_matches), filenames)
+
+
+def atomic_write(filename, content, encoding='utf-8', perms=0o644):
+    """
+    Replace the contents of a file by writing a temporary file alongside it
+    and renaming it into place.
+
+    Readers never see a partially written file, and the mode and ownership
+    of an existing file are preserved (`perms` only applies to new files).
+    Because the file is replaced rather than rewritten, any hard links to
+    the old contents are left untouched.  Symlinks are followed, so it is
+    the file they point to that is replaced.
+    """
+    filename = os.path.realpath(filename)
+    if not isinstance(content, bytes):
+        content = content.encode(encoding)
+    fd, tmp = mkstemp(dir=os.path.dirname(filename),
+                      prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        if os.path.exists(filename):
+            st = os.stat(filename)
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp, perms)
+        os.rename(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+_xml_root_cache = {}
+
+
+def _parse_xml(filename):
+    """
+    Parse an XML file and return its root element, reusing the previous
+    result for as long as the file is unchanged.  Each caller gets its own
+    copy of the tree.
+    """
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = _file_stamp(st)
+    cached = _xml_root_cache.get(filename)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, ET.parse(filename).getroot())
+        _xml_root_cache[filename] = cached
+    return copy.deepcopy(cached[1])
 
 
 @contextmanager
@@ -234,8 +401,7 @@ def xmlpropmap_edit_in_place(filename):
 
     Note that the file is not locked during the edits.
     """
-    tree = ET.parse(filename)
-    root = tree.getroot()
+    root = _parse_xml(filename)
     props = {}
     for prop in root.findall('property'):
         props[prop.find('name').text] = prop.find('value').text
@@ -255,11 +421,50 @@ def xmlpropmap_edit_in_place(filename):
         prop = ET.SubElement(root, 'property')
         ET.SubElement(prop, 'name').text = name
         ET.SubElement(prop, 'value').text = str(props[name])
-    for node in tree.iter():
+    for node in root.iter():
         node.tail = None
         node.text = (node.text or '').strip() or None
-    prettied = minidom.parseString(ET.tostring(root)).toprettyxml(indent='    ')
-    Path(filename).write_text(prettied)
+    atomic_write(filename, _pretty_xml(root))
+
+
+def _xml_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+def _write_pretty_xml(elem, out, indent):
+    out.append('%s<%s' % (indent, elem.tag))
+    for name, value in elem.attrib.items():
+        out.append(' %s="%s"' % (name, _xml_escape(value)))
+    children = list(elem)
+    if not children:
+        if elem.text is None:
+            out.append('/>\n')
+        else:
+            out.append('>%s</%s>\n' % (_xml_escape(elem.text), elem.tag))
+        return
+    out.append('>\n')
+    if elem.text is not None:
+        out.append('%s    %s\n' % (indent, _xml_escape(elem.text)))
+    for child in children:
+        _write_pretty_xml(child, out, indent + '    ')
+    out.append('%s</%s>\n' % (indent, elem.tag))
+
+
+def _pretty_xml(root):
+    """
+    Serialize a whitespace-stripped ElementTree as indented XML.
+
+    The output is the same as minidom's ``toprettyxml(indent='    ')``, but
+    without having to re-parse the document into a DOM first.  Documents
+    using namespaces still go through minidom, which handles the prefixes.
+    """
+    for elem in root.iter():
+        if not isinstance(elem.tag, str) or elem.tag.startswith('{') or \
+                any(name.startswith('{') for name in elem.attrib):
+            return minidom.parseString(ET.tostring(root)).toprettyxml(indent='    ')
+    out = ['<?xml version="1.0" ?>\n']
+    _write_pretty_xml(root, out, '')
+    return ''.join(out)
 
 
 @contextmanager
@@ -276,10 +481,11 @@ def environment_edit_in_place(filename='/etc/environment'):
     Also note that the file is not locked during the edits.
     """
     etc_env = Path(filename)
-    lines = [l.strip().split('=', 1) for l in etc_env.lines()]
+    lines = [line.strip().split('=', 1) for line in etc_env.text().splitlines() if '=' in line]
     data = {k.strip(): v.strip(' \'"') for k, v in lines}
     yield data
     etc_env.write_lines('{}="{}"'.format(k, v) for k, v in data.items())
+    _etc_env_cache.pop('env', None)
 
 
 def strtobool(value):
@@ -291,22 +497,66 @@ def normalize_strbool(value):
     return str(bool(intbool)).lower()
 
 
-def jps(name):
+# How long (in seconds) the list of running Java processes is reused by jps()
+JPS_CACHE_TTL = 1
+_java_procs_cache = {}
+_jps_patterns = {}
+
+
+def java_processes(refresh=False):
+    """
+    Get the (PID, command line) pairs of all running Java processes.
+
+    The list is cached for :data:`JPS_CACHE_TTL` seconds so that a series of
+    :func:`jps` queries only costs a single ``pgrep``.  Pass `refresh=True`
+    to take a new snapshot regardless.
+    """
+    now = time.time()
+    # the snapshot is a single (time, procs) entry, replaced as a whole, so
+    # that it is safe to use (and clear) from several threads
+    snapshot = _java_procs_cache.get('snapshot')
+    if refresh or snapshot is None or now - snapshot[0] > JPS_CACHE_TTL:
+        try:
+            output = check_output(['sudo', 'pgrep', '-a', '-f', '^[^ ]*java ']).decode('utf8')
+        except CalledProcessError:
+            output = ''
+        procs = [line.split(' ', 1)
+                 for line in output.strip().splitlines()
+                 if ' ' in line]
+        snapshot = _java_procs_cache['snapshot'] = (now, procs)
+    return snapshot[1]
+
+
+def clear_jps_cache():
+    """
+    Discard the cached list of Java processes used by :func:`jps`.
+
+    This should be called after starting or stopping a Java daemon.
+    """
+    _java_procs_cache.pop('snapshot', None)
+
+
+def jps(name, refresh=False):
     """
     Get PIDs for named Java processes, for any user.
     """
-    pat = re.sub(r'^(.)', r'^[^ ]*java .*[\1]', name)
-    try:
-        output = check_output(['sudo', 'pgrep', '-f', pat]).decode('utf8')
-    except CalledProcessError:
-        return []
-    return filter(None, output.strip().splitlines())
+    if name not in _jps_patterns:
+        _jps_patterns[name] = re.compile(r'^[^ ]*java .*' + name)
+    pat = _jps_patterns[name]
+    return [pid for pid, cmdline in java_processes(refresh) if pat.search(cmdline)]
 
 
 class TimeoutError(Exception):
     pass
 
 
+# proxy vars are conventionally either all lower or all upper case
+_PROXY_SUFFIXES = ('_proxy', '_PROXY')
+
+# the parsed contents of /etc/environment, along with its stat stamp
+_etc_env_cache = {}
+
+
 def read_etc_env():
     """
     Read /etc/environment and return it, along with proxy configuration, as
@@ -318,13 +568,26 @@ def read_etc_env():
     # /etc/environment on a Juju unit, but we should pass it along so anyone
     # using this env will have correct proxy settings.
     env.update({k: v for k, v in os.environ.items()
-                if k.lower().endswith('_proxy')})
+                if k.endswith(_PROXY_SUFFIXES)})
 
     etc_env = Path('/etc/environment')
-    if etc_env.exists():
-        for line in etc_env.lines(retain=False):
+    try:
+        st = etc_env.stat()
+    except OSError:
+        return env
+    stamp = _file_stamp(st)
+    # a single (stamp, env) entry, replaced as a whole, so that it is safe
+    # to use (and clear) from several threads
+    cached = _etc_env_cache.get('env')
+    if cached is None or cached[0] != stamp:
+        parsed = {}
+        for line in etc_env.text().splitlines():
+            if '=' not in line:
+                continue
             var, value = line.split('=', 1)
-            env[var.strip()] = value.strip(' \'"')
+            parsed[var.strip()] = value.strip(' \'"')
+        cached = _etc_env_cache['env'] = (stamp, parsed)
+    env.update(cached[1])
     return env
 
 
@@ -347,21 +610,22 @@ def run_as(user, command, *args, **kwargs):
     env = read_etc_env()
     if 'env' in kwargs:
         env.update(kwargs['env'])
-    if kwargs.get('capture_output'):
-        def run(*a, **kw):
-            return check_output(*a, **kw).decode('utf8')
-    else:
-        run = check_call
-    try:
-        stdin = None
-        if 'input' in kwargs:
-            stdin = NamedTemporaryFile()
-            stdin.write(kwargs['input'])
-            stdin.seek(0)
-        return run(['su', user, '-c', quoted], env=env, stdin=stdin)
-    finally:
-        if stdin:
-            stdin.close()  # this also removes tempfile
+    cmd = ['su', user, '-c', quoted]
+    capture_output = kwargs.get('capture_output')
+    if 'input' not in kwargs:
+        if capture_output:
+            return check_output(cmd, env=env).decode('utf8')
+        return check_call(cmd, env=env)
+    # feed the input through a pipe, rather than staging it in a temp file
+    stdin = kwargs['input']
+    if not isinstance(stdin, bytes):
+        stdin = stdin.encode('utf8')
+    proc = Popen(cmd, env=env, stdin=subprocess.PIPE,
+                 stdout=subprocess.PIPE if capture_output else None)
+    output, _ = proc.communicate(stdin)
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd, output)
+    return output.decode('utf8') if capture_output else proc.returncode
 
 
 def run_bg_as(user, output_log, command, *args):
@@ -379,6 +643,17 @@ def run_bg_as(user, output_log, command, *args):
           env=e)
 
 
+_CONTAINS_IP_RE = re.compile(r'\d{1,3}[-.]\d{1,3}[-.]\d{1,3}[-.]\d{1,3}')
+
+
+def _is_ipv4(addr):
+    try:
+        socket.inet_pton(socket.AF_INET, addr)
+    except (socket.error, ValueError):
+        return False
+    return True
+
+
 def update_etc_hosts(ips_to_names):
     '''
     Update /etc/hosts given a mapping of managed IP / hostname pairs.
@@ -389,28 +664,31 @@ def update_etc_hosts(ips_to_names):
     :param dict ips_to_names: mapping of IPs to hostnames (must be one-to-one)
     '''
     etc_hosts = Path('/etc/hosts')
-    hosts_contents = etc_hosts.lines()
-    IP_pat = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-
-    new_lines = []
-    managed = {}
-    for line in hosts_contents:
-        if '# JUJU MANAGED' not in line:
-            # pass-thru unmanaged lines unchanged
-            new_lines.append(line)
-    # add or update new hosts
-    managed.update({name: ip for ip, name in ips_to_names.items()})
+    old_contents = etc_hosts.text()
+    hosts_contents = old_contents.splitlines()
 
-    # render all of our managed entries as lines
-    for name, ip in managed.items():
+    # pass-thru unmanaged lines unchanged
+    new_lines = [line for line in hosts_contents if '# JUJU MANAGED' not in line]
+
+    # render all of our managed entries as lines, in a stable order so that
+    # an unchanged set of hosts doesn't rewrite the file
+    for ip, name in sorted(ips_to_names.items(), key=lambda item: item[1]):
         line = '%s %s  # JUJU MANAGED' % (ip, name)
-        if not IP_pat.match(ip):
+        if not _is_ipv4(ip):
             line = '# %s (INVALID IP)' % line
         # add new host
         new_lines.append(line)
 
-    # write new /etc/hosts
-    etc_hosts.write_lines(new_lines, append=False)
+    # write new /etc/hosts, but only if something changed
+    new_contents = '\n'.join(new_lines) + '\n'
+    if new_contents == old_contents:
+        return
+    try:
+        atomic_write(etc_hosts, new_contents)
+    except OSError:
+        # /etc/hosts may be a bind mount (e.g., in a container), which can't
+        # be replaced by a rename
+        etc_hosts.write_text(new_contents)
 
 
 def manage_etc_hosts():
@@ -425,9 +703,7 @@ def manage_etc_hosts():
 
 
 def resolve_private_address(addr):
-    IP_pat = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-    contains_IP_pat = re.compile(r'\d{1,3}[-.]\d{1,3}[-.]\d{1,3}[-.]\d{1,3}')
-    if IP_pat.match(addr):
+    if _is_ipv4(addr):
         return addr  # already IP
     try:
         ip = socket.gethostbyname(addr)
@@ -435,10 +711,10 @@ def resolve_private_address(addr):
     except socket.error as e:
         hookenv.log('Unable to resolve private IP: %s (will attempt to guess)' % addr, hookenv.ERROR)
         hookenv.log('%s' % e, hookenv.ERROR)
-        contained = contains_IP_pat.search(addr)
+        contained = _CONTAINS_IP_RE.search(addr)
         if not contained:
             raise ValueError('Unable to resolve or guess IP from private-address: %s' % addr)
-        return contained.groups(0).replace('-', '.')
+        return contained.group(0).replace('-', '.')
 
 
 def check_connect(addr, port):
@@ -472,6 +748,28 @@ def initialize_kv_host():
     update_kv_host(local_ip, local_host)
 
 
+_kv_flush_registered = []
+
+
+def _flush_kv_if_clean():
+    # the interpreter sets sys.last_value when the hook dies with an uncaught
+    # exception; don't persist the partial state of a failed hook
+    if getattr(sys, 'last_value', None) is None:
+        unitdata.kv().flush(True)
+
+
+def flush_kv_on_exit():
+    """
+    Arrange for the unit's kv store to be flushed once when the hook exits,
+    instead of committing (and syncing) after every individual write.
+
+    Nothing is flushed if the hook fails with an uncaught exception.
+    """
+    if not _kv_flush_registered:
+        atexit.register(_flush_kv_if_clean)
+        _kv_flush_registered.append(True)
+
+
 def get_kv_hosts():
     return unitdata.kv().getrange('etc_host.', strip=True)
 
@@ -479,13 +777,13 @@ def get_kv_hosts():
 def update_kv_host(ip, host):
     unit_kv = unitdata.kv()
 
-    remove_kv_hosts(host)  # ensure a given host only has one IP
+    _unset_kv_hosts(unit_kv, [host])  # ensure a given host only has one IP
 
     # store attrs in the kv as 'etc_host.<ip>'; kv.update will insert
     # a new record or update any existing key with current data.
     unit_kv.update({ip: host},
                    prefix="etc_host.")
-    unit_kv.flush(True)
+    unit_kv.flush(True)  # one commit for both the removal and the update
 
 
 def update_kv_hosts(ips_to_names):
@@ -502,13 +800,21 @@ def remove_kv_hosts(*hosts):
     if len(hosts) == 1 and isinstance(hosts[0], (list, tuple)):
         hosts = hosts[0]
     unit_kv = unitdata.kv()
+    _unset_kv_hosts(unit_kv, hosts)
+    unit_kv.flush(True)
+
+
+def _unset_kv_hosts(unit_kv, hosts):
+    """
+    Remove all IPs for the given hosts from the kv, without committing.
+    """
+    hosts = set(hosts)
     kv_hosts = get_kv_hosts()
     # find all IPs for the given host
     to_remove = [ip for ip, h in kv_hosts.items() if h in hosts]
     # remove all IPs for the given host
     unit_kv.unsetrange(to_remove,
                        prefix="etc_host.")
-    unit_kv.flush(True)
 
 
 def ssh_key_dir(user):
@@ -530,10 +836,7 @@ def generate_ssh_key(user):
     if not sshdir.exists():
         host.mkdir(sshdir, owner=user, group='hadoop', perms=0o755)
     keyfile = ssh_priv_key(user)
-    (sshdir / 'config').write_lines([
-        'Host *',
-        '    StrictHostKeyChecking no'
-    ], append=True)
+    (sshdir / 'config').write_text('Host *\n    StrictHostKeyChecking no\n', append=True)
     check_call(['ssh-keygen', '-t', 'rsa', '-P', '', '-f', keyfile])
     host.chownr(sshdir, user, 'hadoop')
 
@@ -548,10 +851,19 @@ def get_ssh_key(user):
 
 
 def install_ssh_key(user, ssh_key):
+    """
+    Authorize `ssh_key` for `user`, unless it is already authorized.
+    """
     sshdir = ssh_key_dir(user)
     if not sshdir.exists():
         host.mkdir(sshdir, owner=user, group='hadoop', perms=0o755)
-    Path(sshdir / 'authorized_keys').write_text(ssh_key, append=True)
+    authfile = Path(sshdir / 'authorized_keys')
+    authorized = authfile.text() if authfile.exists() else ''
+    ssh_key = ssh_key.strip()
+    if ssh_key in (line.strip() for line in authorized.splitlines()):
+        return
+    separator = '\n' if authorized and not authorized.endswith('\n') else ''
+    authfile.write_text(separator + ssh_key + '\n', append=True)
     host.chownr(sshdir, user, 'hadoop')
 
 
@@ -564,20 +876,65 @@ def wait_for_connect(addr, port, timeout):
     raise TimeoutError('Timed-out waiting for connection to %s on port %s' % (addr, port))
 
 
+def parallel_map(func, items):
+    """
+    Call `func` on each of `items` concurrently, in a pool of threads, and
+    return the results in order.
+
+    This is only worthwhile for slow, I/O-bound calls, such as starting
+    services or running commands that launch a JVM.
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+    pool = ThreadPool(len(items))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def wait_until(predicate, timeout=30, interval=0.5):
+    """
+    Poll `predicate` until it returns a true value or `timeout` seconds pass.
+
+    The delay between polls starts at `interval` and doubles after each
+    attempt, up to 5 seconds.  Unlike the `wait_for_*` helpers, this does
+    not raise on timeout.
+
+    :returns: True if the predicate was satisfied, False if it timed out
+    """
+    start = time.time()
+    while True:
+        if predicate():
+            return True
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 5)
+
+
 def wait_for_hdfs(timeout):
     start = time.time()
-    while time.time() - start < timeout:
+    interval = 2
+    while True:
         try:
+            # one JVM per attempt: the report also starts with
+            # "Safe mode is ON" while the NameNode is in safe mode
             output = run_as('hdfs', 'hdfs', 'dfsadmin', '-report', capture_output=True)
             datanodes = 'Datanodes available' in output or 'Live datanodes' in output
-            output = run_as('hdfs', 'hdfs', 'dfsadmin', '-safemode', 'get',
-                            capture_output=True)
-            safemode = 'Safe mode is OFF' not in output
+            safemode = 'Safe mode is ON' in output
             if datanodes and not safemode:
                 return True
         except CalledProcessError as e:
             output = e.output  # probably a "connection refused"; wait and try again
-        time.sleep(2)
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 10)
     raise TimeoutError('Timed-out waiting for HDFS:\n%s' % output)
 
 
@@ -592,8 +949,21 @@ def wait_for_jps(process_name, timeout):
     raise TimeoutError('Timed-out waiting for jps process:\n%s' % process_name)
 
 
+_cpu_arch_cache = {}
+
+
 def cpu_arch():
-    return subprocess.check_output(['uname', '-p']).decode('utf8').strip()
+    """
+    Get the processor type of this machine, e.g. ``x86_64``.
+
+    The result is cached, since the architecture won't change mid-hook.
+    """
+    if 'arch' not in _cpu_arch_cache:
+        arch = os.uname()[4]  # the machine field, as reported by uname -m
+        if not arch:
+            arch = subprocess.check_output(['uname', '-p']).decode('utf8').strip()
+        _cpu_arch_cache['arch'] = arch
+    return _cpu_arch_cache['arch']
 
 
 class verify_resources(object):
@@ -615,7 +985,13 @@ class verify_resources(object):
         if not jujuresources.verify(self.which):
             mirror_url = hookenv.config('resources_mirror')
             hookenv.status_set('maintenance', 'Fetching resources')
-            result = jujuresources.fetch(self.which, mirror_url=mirror_url)
+            invalid = jujuresources.invalid(self.which)
+            if len(invalid) > 1:
+                # downloads are network-bound, so fetch each resource in its own thread
+                results = parallel_map(lambda name: jujuresources.fetch([name], mirror_url=mirror_url), invalid)
+                result = all(results)
+            else:
+                result = jujuresources.fetch(self.which, mirror_url=mirror_url)
             if not result:
                 missing = jujuresources.invalid(self.which)
                 hookenv.status_set('blocked', 'Unable to fetch required resource%s: %s' % (
@@ -626,7 +1002,7 @@ class verify_resources(object):
 
 
 def spec_matches(local_spec, remote_spec):
-    for k, v in local_spec.items():
-        if v != remote_spec.get(k):
-            return False
-    return True
+    if six.viewitems(local_spec) <= six.viewitems(remote_spec):
+        return True
+    # slow path, which also lets a local None match a missing remote key
+    return not any(v != remote_spec.get(k) for k, v in local_spec.items())
@@ -16,6 +16,11 @@ import ruamel.yaml
 sys.path.append('.')
 from charmhelpers.core.host import chdir
 
+DOWNLOAD_URL = 'http://bazaar.launchpad.net/~bigdata-dev/bigdata-data/trunk/download/head:/common/noarch/'
+
+# share one connection to Launchpad across requests
+session = requests.Session()
+
 
 def parse_args(args):
     parser = argparse.ArgumentParser()
@@ -36,12 +41,19 @@ def parse_args(args):
     return parser.parse_args(args)
 
 
+def file_hash(filename, blocksize=1024 * 1024):
+    hasher = sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
 def get_latest(repo):
     with chdir(repo):
         check_call(['bzr', 'pull'])
         filename = glob('common/noarch/jujubigdata-*')[0]
-        with open(filename) as fp:
-            hash = sha256(fp.read()).hexdigest()
+        hash = file_hash(filename)
     print "Hash: {}".format(hash)
     return os.path.abspath(filename), hash
 
@@ -50,8 +62,7 @@ def build():
     check_call(['make', 'clean'])
     check_call(['make', 'sdist'])
     filename = glob('dist/jujubigdata-*.tar.gz')[0]
-    with open(filename) as fp:
-        hash = sha256(fp.read()).hexdigest()
+    hash = file_hash(filename)
     print "Hash: {}".format(hash)
     return os.path.abspath(filename), hash
 
@@ -68,8 +79,12 @@ def upload(filename, repo, message, testing):
 
 def get_url(filename, testing):
     if not testing:
+        url = urljoin(DOWNLOAD_URL, os.path.basename(filename))
+        if session.head(url, allow_redirects=True).ok:
+            return url
+        # fall back to scraping the listing, in case the download URL scheme has changed
         download_page = 'http://bazaar.launchpad.net/~bigdata-dev/bigdata-data/trunk/files/head:/common/noarch/'
-        page = requests.get(download_page)
+        page = session.get(download_page)
         match = re.search(r'<a href="([^"]*)" title="Download jujubigdata-', page.text)
         assert match, 'Unable to find download URL'
         url = urljoin(download_page, match.group(1))
@@ -7,6 +7,11 @@ version_file = os.path.abspath(os.path.join(os.path.dirname(__file__),
 with open(version_file) as v:
     VERSION = v.read().strip()
 
+readme_file = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           'README.rst'))
+with open(readme_file) as r:
+    README = r.read()
+
 
 SETUP = {
     'name': "jujubigdata",
@@ -28,7 +33,7 @@ SETUP = {
     'scripts': [
     ],
     'license': "Apache License v2.0",
-    'long_description': open('README.rst').read(),
+    'long_description': README,
     'description': 'Helpers for Juju Charm development for Big Data',
     'package_data': {'jujubigdata': ['templates/*']},
 }
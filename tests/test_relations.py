@@ -54,6 +54,24 @@ class TestSpecMatchingRelation(unittest.TestCase):
         self.data = {'unit/0': {'spec': '{"field": "invalid"}', 'foo': 'bar'}}
         self.assertRaises(ValueError, self.relation.is_ready)
 
+    def test_remote_spec_parsed_once(self):
+        self.data = {
+            'unit/0': {'spec': '{"field": "valid", "other": "x"}', 'foo': 'bar'},
+            'unit/1': {'spec': '{"field": "valid", "other": "x"}', 'foo': 'bar'},
+        }
+        relations._remote_spec_cache.clear()
+        with mock.patch.object(relations, '_loads', wraps=relations._loads) as loads:
+            self.assertTrue(self.relation.is_ready())
+            self.assertEqual(loads.call_count, 1)
+
+    def test_required_keys_not_shared(self):
+        relation = relations.DataNode(
+            spec={'field': 'valid'},
+            datastore=mock.MagicMock(),
+            cache={})
+        self.assertIn('spec', relation.required_keys)
+        self.assertNotIn('spec', relations.DataNode.required_keys)
+
 
 if __name__ == '__main__':
     unittest.main()
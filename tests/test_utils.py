@@ -13,6 +13,8 @@
 
 
 import os
+import pwd
+import sys
 import tempfile
 import unittest
 import mock
@@ -21,17 +23,52 @@ from path import Path
 from jujubigdata import utils
 
 
+_XML_FIXTURE = (
+    '<?xml version="1.0"?>\n'
+    '<?xml-stylesheet type="text/xsl" href="configuration.xsl"?>\n'
+    '\n'
+    '<!-- Put site-specific property overrides in this file. -->\n'
+    '\n'
+    '<configuration>\n'
+    '   <property>\n'
+    '       <name>modify.me</name>\n'
+    '       <value>1</value>\n'
+    '       <description>Property to be modified</description>\n'
+    '   </property>\n'
+    '   <property>\n'
+    '       <name>delete.me</name>\n'
+    '       <value>None</value>\n'
+    '       <description>Property to be removed</description>\n'
+    '   </property>\n'
+    '   <property>\n'
+    '       <name>do.not.modify.me</name>\n'
+    '       <value>0</value>\n'
+    '       <description>Property to *not* be modified</description>\n'
+    '   </property>\n'
+    '</configuration>'
+).encode('utf-8')
+
+
 class TestError(RuntimeError):
     pass
 
 
 class TestUtils(unittest.TestCase):
+    @mock.patch.object(utils, 'check_output', mock.Mock(return_value=b'Status: active\n'))
     def test_disable_firewall(self):
         with mock.patch.object(utils, 'check_call') as check_call:
             with utils.disable_firewall():
                 check_call.assert_called_once_with(['ufw', 'disable'])
             check_call.assert_called_with(['ufw', 'enable'])
 
+    @mock.patch.object(utils, 'check_output', mock.Mock(return_value=b'Status: inactive\n'))
+    def test_disable_firewall_already_disabled(self):
+        with mock.patch.object(utils, 'check_call') as check_call:
+            with utils.disable_firewall():
+                pass
+            self.assertFalse(check_call.called)
+
+    @mock.patch.object(utils, 'check_output', mock.Mock(return_value=b'Status: active\n'))
     def test_disable_firewall_on_error(self):
         with mock.patch.object(utils, 'check_call') as check_call:
             try:
@@ -41,12 +78,42 @@ class TestUtils(unittest.TestCase):
             except TestError:
                 check_call.assert_called_with(['ufw', 'enable'])
 
+    def test_dist_config_cached(self):
+        fd, filename = tempfile.mkstemp(suffix='.yaml')
+        os.close(fd)
+        tmp_file = Path(filename)
+        try:
+            tmp_file.write_text('dirs:\n  hadoop:\n    path: /usr/lib/hadoop\n')
+            with mock.patch.object(utils.yaml, 'load', wraps=utils.yaml.load) as load:
+                first = utils.DistConfig(filename)
+                first.dirs['hadoop']['path'] = '/changed'
+                second = utils.DistConfig(filename)
+                self.assertEqual(load.call_count, 1)
+            self.assertEqual(second.dirs['hadoop']['path'], '/usr/lib/hadoop')
+        finally:
+            tmp_file.remove()
+
+    def test_dist_config_replaced(self):
+        fd, filename = tempfile.mkstemp(suffix='.yaml')
+        os.close(fd)
+        tmp_file = Path(filename)
+        try:
+            tmp_file.write_text('dirs:\n  hadoop:\n    path: /usr/lib/hadoop\n')
+            st = tmp_file.stat()
+            utils.DistConfig(filename)
+            # same size and mtime, but a new inode
+            utils.atomic_write(filename, 'dirs:\n  hadoop:\n    path: /opt/lib/hadoop\n')
+            os.utime(filename, (st.st_atime, st.st_mtime))
+            self.assertEqual(utils.DistConfig(filename).dirs['hadoop']['path'], '/opt/lib/hadoop')
+        finally:
+            tmp_file.remove()
+
     def test_re_edit_in_place(self):
         fd, filename = tempfile.mkstemp()
+        os.write(fd, b'foo\nbar\nqux')
         os.close(fd)
         tmp_file = Path(filename)
         try:
-            tmp_file.write_text('foo\nbar\nqux')
             utils.re_edit_in_place(tmp_file, {
                 r'oo$': 'OO',
                 r'a': 'A',
@@ -56,34 +123,106 @@ class TestUtils(unittest.TestCase):
         finally:
             tmp_file.remove()
 
+    def test_combine_patterns(self):
+        def compiled(*pats):
+            return [(pat, utils.re.compile(pat), '') for pat in pats]
+        combined = utils._combine_patterns(compiled(r'oo$', r'^qux$'))
+        self.assertTrue(combined.search('foo'))
+        self.assertTrue(combined.search('qux'))
+        self.assertFalse(combined.search('quxx'))
+        self.assertIsNone(utils._combine_patterns(compiled(r'a')))
+        self.assertIsNone(utils._combine_patterns(compiled(r'(a)\1', r'b')))
+        self.assertIsNone(utils._combine_patterns(compiled(r'(?i)a', r'b')))
+
+    def test_re_edit_in_place_combined_syntax(self):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, b'xxy\nb\n')
+        os.close(fd)
+        try:
+            # `{,2}` is a bounded repeat in Python, but a literal in some engines
+            utils.re_edit_in_place(filename, {r'^x{,2}y$': 'Z', r'^a$': 'A'})
+            self.assertEqual(Path(filename).text(), 'Z\nb\n')
+        finally:
+            os.remove(filename)
+
+    def test_re_edit_in_place_many_lines(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        tmp_file = Path(filename)
+        try:
+            tmp_file.write_text(''.join('key%d=value\n' % i for i in range(1000)))
+            with mock.patch.object(utils.re, 'compile', wraps=utils.re.compile) as compile:
+                utils.re_edit_in_place(tmp_file, {
+                    r'^key999=.*$': 'key999=last',
+                    r'^missing=.*$': 'missing=added',
+                }, append_non_matches=True)
+                # once per pattern, plus the combined alternation
+                self.assertEqual(compile.call_count, 3)
+            lines = tmp_file.lines(retain=False)
+            self.assertEqual(len(lines), 1001)
+            self.assertEqual(lines[0], 'key0=value')
+            self.assertEqual(lines[-2:], ['key999=last', 'missing=added'])
+        finally:
+            tmp_file.remove()
+
+    def test_re_editor(self):
+        tmpdir = Path(tempfile.mkdtemp())
+        try:
+            files = [tmpdir / 'a', tmpdir / 'b']
+            files[0].write_text('foo\n')
+            files[1].write_text('bar\n')
+            with mock.patch.object(utils.re, 'compile', wraps=utils.re.compile) as compile:
+                edit = utils.re_editor({r'^foo$': 'FOO', r'^bar$': 'BAR'})
+                for filename in files:
+                    edit(filename)
+                # once per pattern, plus the combined alternation
+                self.assertEqual(compile.call_count, 3)
+            self.assertEqual(files[0].text(), 'FOO\n')
+            self.assertEqual(files[1].text(), 'BAR\n')
+        finally:
+            tmpdir.rmtree_p()
+
+    def test_re_edit_in_place_many(self):
+        tmpdir = Path(tempfile.mkdtemp())
+        try:
+            files = [tmpdir / str(i) for i in range(4)]
+            for filename in files:
+                filename.write_text('foo\nbar\n')
+            utils.re_edit_in_place_many(files, {r'^foo$': 'FOO'})
+            for filename in files:
+                self.assertEqual(filename.text(), 'FOO\nbar\n')
+        finally:
+            tmpdir.rmtree_p()
+
+    def test_re_edit_in_place_line_breaks(self):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, u'a\x0cfoo\nx\u2028foo\nfoo\n'.encode('utf8'))
+        os.close(fd)
+        try:
+            utils.re_edit_in_place(filename, {r'^foo': 'X'})
+            with open(filename, 'rb') as fp:
+                self.assertEqual(fp.read().decode('utf8'), u'a\x0cfoo\nx\u2028foo\nX\n')
+        finally:
+            os.remove(filename)
+
+    @mock.patch.object(utils, 'atomic_write')
+    def test_re_edit_in_place_unchanged(self, atomic_write):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        tmp_file = Path(filename)
+        try:
+            tmp_file.write_text('foo\nbar\n')
+            utils.re_edit_in_place(tmp_file, {r'^baz$': 'BAZ'})
+            self.assertFalse(atomic_write.called)
+        finally:
+            tmp_file.remove()
+
     def test_xmlpropmap_edit_in_place(self):
         fd, filename = tempfile.mkstemp()
+        os.write(fd, _XML_FIXTURE)
         os.close(fd)
         tmp_file = Path(filename)
         try:
-            tmp_file.write_text(
-                '<?xml version="1.0"?>\n'
-                '<?xml-stylesheet type="text/xsl" href="configuration.xsl"?>\n'
-                '\n'
-                '<!-- Put site-specific property overrides in this file. -->\n'
-                '\n'
-                '<configuration>\n'
-                '   <property>\n'
-                '       <name>modify.me</name>\n'
-                '       <value>1</value>\n'
-                '       <description>Property to be modified</description>\n'
-                '   </property>\n'
-                '   <property>\n'
-                '       <name>delete.me</name>\n'
-                '       <value>None</value>\n'
-                '       <description>Property to be removed</description>\n'
-                '   </property>\n'
-                '   <property>\n'
-                '       <name>do.not.modify.me</name>\n'
-                '       <value>0</value>\n'
-                '       <description>Property to *not* be modified</description>\n'
-                '   </property>\n'
-                '</configuration>')
             with utils.xmlpropmap_edit_in_place(tmp_file) as props:
                 del props['delete.me']
                 props['modify.me'] = 'one'
@@ -110,6 +249,242 @@ class TestUtils(unittest.TestCase):
         finally:
             tmp_file.remove()
 
+    def test_parse_xml_cached(self):
+        fd, filename = tempfile.mkstemp(suffix='.xml')
+        os.close(fd)
+        tmp_file = Path(filename)
+        try:
+            tmp_file.write_text('<configuration><property><name>a</name></property></configuration>')
+            with mock.patch.object(utils.ET, 'parse', wraps=utils.ET.parse) as parse:
+                first = utils._parse_xml(filename)
+                first.remove(first.find('property'))
+                second = utils._parse_xml(filename)
+                self.assertEqual(parse.call_count, 1)
+            self.assertEqual(second.find('property/name').text, 'a')
+        finally:
+            tmp_file.remove()
+
+    def test_atomic_write(self):
+        tmpdir = Path(tempfile.mkdtemp())
+        try:
+            target = tmpdir / 'target'
+            link = tmpdir / 'link'
+            target.write_text('old')
+            target.chmod(0o640)
+            os.link(target, link)
+            utils.atomic_write(target, 'new')
+            self.assertEqual(target.text(), 'new')
+            self.assertEqual(link.text(), 'old')
+            self.assertEqual(target.stat().st_mode & 0o777, 0o640)
+            self.assertEqual(sorted(tmpdir.listdir()), sorted([target, link]))
+        finally:
+            tmpdir.rmtree_p()
+
+    def test_atomic_write_symlink(self):
+        tmpdir = Path(tempfile.mkdtemp())
+        try:
+            target = tmpdir / 'target'
+            link = tmpdir / 'link'
+            target.write_text('old')
+            target.chmod(0o640)
+            target.symlink(link)
+            utils.atomic_write(link, 'new')
+            self.assertTrue(link.islink())
+            self.assertEqual(target.text(), 'new')
+            self.assertEqual(target.stat().st_mode & 0o777, 0o640)
+        finally:
+            tmpdir.rmtree_p()
+
+    @mock.patch.object(utils.host, 'chownr')
+    @mock.patch.object(utils, 'ssh_key_dir')
+    def test_install_ssh_key(self, ssh_key_dir, chownr):
+        sshdir = Path(tempfile.mkdtemp())
+        ssh_key_dir.return_value = sshdir
+        try:
+            (sshdir / 'authorized_keys').write_text('ssh-rsa AAAA local')
+            utils.install_ssh_key('ubuntu', 'ssh-rsa BBBB remote\n')
+            utils.install_ssh_key('ubuntu', 'ssh-rsa BBBB remote')
+            self.assertEqual((sshdir / 'authorized_keys').text(),
+                             'ssh-rsa AAAA local\nssh-rsa BBBB remote\n')
+            chownr.assert_called_once_with(sshdir, 'ubuntu', 'hadoop')
+        finally:
+            sshdir.rmtree_p()
+
+    @mock.patch.object(utils, 'check_output')
+    def test_jps(self, check_output):
+        utils.clear_jps_cache()
+        check_output.return_value = (
+            b'123 /usr/bin/java -Dproc_namenode org.apache.hadoop.hdfs.server.namenode.NameNode\n'
+            b'456 /usr/bin/java -Dproc_datanode org.apache.hadoop.hdfs.server.datanode.DataNode\n')
+        self.assertEqual(utils.jps('NameNode'), ['123'])
+        self.assertEqual(utils.jps('DataNode'), ['456'])
+        self.assertEqual(utils.jps('ResourceManager'), [])
+        self.assertEqual(check_output.call_count, 1)
+        utils.clear_jps_cache()
+        utils.jps('NameNode')
+        self.assertEqual(check_output.call_count, 2)
+        utils.jps('NameNode', refresh=True)
+        self.assertEqual(check_output.call_count, 3)
+
+    @mock.patch.object(utils, 'check_output')
+    def test_jps_concurrent_clear(self, check_output):
+        check_output.return_value = b'123 /usr/bin/java NameNode\n'
+
+        def query(i):
+            for _ in range(2000):
+                if i % 2:
+                    utils.clear_jps_cache()
+                else:
+                    self.assertEqual(utils.jps('NameNode'), ['123'])
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible
+        try:
+            utils.parallel_map(query, range(8))
+        finally:
+            sys.setswitchinterval(interval)
+
+        # the worst case interleaving: another thread clears the cache as
+        # soon as a snapshot has been stored
+        class ClearedOnWrite(dict):
+            def __setitem__(self, key, value):
+                self.clear()
+        with mock.patch.object(utils, '_java_procs_cache', ClearedOnWrite()):
+            self.assertEqual(utils.jps('NameNode'), ['123'])
+
+    @mock.patch.object(utils.atexit, 'register')
+    def test_flush_kv_on_exit(self, register):
+        del utils._kv_flush_registered[:]
+        utils.flush_kv_on_exit()
+        utils.flush_kv_on_exit()
+        self.assertEqual(register.call_count, 1)
+        with mock.patch.object(utils.unitdata, 'kv') as kv:
+            register.call_args[0][0]()
+            kv.return_value.flush.assert_called_once_with(True)
+        with mock.patch.object(utils.unitdata, 'kv') as kv, \
+                mock.patch.object(utils.sys, 'last_value', RuntimeError('hook failed'), create=True):
+            register.call_args[0][0]()
+            self.assertFalse(kv.return_value.flush.called)
+
+    def test_parallel_map(self):
+        self.assertEqual(utils.parallel_map(lambda x: x * 2, range(5)), [0, 2, 4, 6, 8])
+        self.assertEqual(utils.parallel_map(str, [1]), ['1'])
+        self.assertEqual(utils.parallel_map(str, []), [])
+
+    @mock.patch.object(utils, 'atomic_write')
+    @mock.patch.object(utils, 'Path')
+    def test_update_etc_hosts(self, Path, atomic_write):
+        Path.return_value.text.return_value = (
+            '127.0.0.1 localhost\n'
+            '10.0.0.9 gone  # JUJU MANAGED\n')
+        utils.update_etc_hosts({'10.0.0.2': 'host-b', '10.0.0.1': 'host-a'})
+        atomic_write.assert_called_once_with(Path.return_value, (
+            '127.0.0.1 localhost\n'
+            '10.0.0.1 host-a  # JUJU MANAGED\n'
+            '10.0.0.2 host-b  # JUJU MANAGED\n'))
+        Path.return_value.text.return_value = atomic_write.call_args[0][1]
+        utils.update_etc_hosts({'10.0.0.1': 'host-a', '10.0.0.2': 'host-b'})
+        self.assertEqual(atomic_write.call_count, 1)
+
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_update_kv_host(self, kv):
+        kv.return_value.getrange.return_value = {'10.0.0.1': 'host-0', '10.0.0.2': 'host-1'}
+        utils.update_kv_host('10.0.0.3', 'host-0')
+        kv.return_value.unsetrange.assert_called_once_with(['10.0.0.1'], prefix='etc_host.')
+        kv.return_value.update.assert_called_once_with({'10.0.0.3': 'host-0'}, prefix='etc_host.')
+        kv.return_value.flush.assert_called_once_with(True)
+
+    @mock.patch.dict(os.environ, {'http_proxy': 'http://proxy:3128'}, clear=True)
+    @mock.patch.object(utils, 'Path')
+    def test_read_etc_env(self, Path):
+        utils._etc_env_cache.clear()
+        Path.return_value.stat.return_value = mock.Mock(st_mtime=1, st_size=2)
+        Path.return_value.text.return_value = 'PATH="/usr/bin:/bin"\n\nJAVA_HOME = /usr/lib/jvm \n'
+        self.assertEqual(utils.read_etc_env(), {
+            'http_proxy': 'http://proxy:3128',
+            'PATH': '/usr/bin:/bin',
+            'JAVA_HOME': '/usr/lib/jvm',
+        })
+        utils._etc_env_cache.clear()
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    @mock.patch.object(utils, 'Path')
+    def test_read_etc_env_concurrent_clear(self, Path):
+        Path.return_value.stat.return_value = mock.Mock(st_ino=1, st_mtime=1, st_size=2)
+        Path.return_value.text.return_value = 'JAVA_HOME=/usr/lib/jvm\n'
+
+        # another thread clears the cache as soon as the new env is stored
+        class ClearedOnWrite(dict):
+            def __setitem__(self, key, value):
+                self.clear()
+        with mock.patch.object(utils, '_etc_env_cache', ClearedOnWrite()):
+            self.assertEqual(utils.read_etc_env(), {'JAVA_HOME': '/usr/lib/jvm'})
+
+    @mock.patch.object(utils, 'read_etc_env')
+    def test_run_as_input(self, read_etc_env):
+        read_etc_env.return_value = dict(os.environ)
+        user = pwd.getpwuid(os.getuid()).pw_name
+        real_popen = utils.Popen
+        with mock.patch.object(utils, 'Popen') as popen:
+            # run the command directly, rather than via su
+            popen.side_effect = lambda cmd, **kw: real_popen(['cat'], **kw)
+            self.assertEqual(utils.run_as(user, 'cat', input=b'data', capture_output=True), 'data')
+            self.assertEqual(popen.call_args[0][0], ['su', user, '-c', "'cat'"])
+
+    @mock.patch.object(utils.socket, 'gethostbyname')
+    def test_resolve_private_address(self, gethostbyname):
+        self.assertEqual(utils.resolve_private_address('10.0.0.1'), '10.0.0.1')
+        self.assertFalse(gethostbyname.called)
+        gethostbyname.side_effect = utils.socket.error('unknown host')
+        with mock.patch.object(utils.hookenv, 'log'):
+            self.assertEqual(utils.resolve_private_address('ip-10-0-0-2.internal'), '10.0.0.2')
+
+    def test_spec_matches(self):
+        self.assertTrue(utils.spec_matches({'a': '1'}, {'a': '1', 'b': '2'}))
+        self.assertTrue(utils.spec_matches({'a': None}, {}))
+        self.assertFalse(utils.spec_matches({'a': '1'}, {'a': '2'}))
+        self.assertFalse(utils.spec_matches({'a': '1', 'b': '2'}, {'a': '1'}))
+
+    @mock.patch.object(utils.hookenv, 'status_set')
+    @mock.patch.object(utils.hookenv, 'config')
+    def test_verify_resources_parallel_fetch(self, config, status_set):
+        config.return_value = 'http://mirror'
+        with mock.patch('jujuresources.verify') as verify, \
+                mock.patch('jujuresources.invalid') as invalid, \
+                mock.patch('jujuresources.fetch') as fetch:
+            verify.return_value = False
+            invalid.return_value = ['hadoop', 'java']
+            fetch.return_value = True
+            self.assertTrue(utils.verify_resources('hadoop', 'java', 'lzo')())
+            self.assertEqual(sorted(fetch.call_args_list), [
+                mock.call(['hadoop'], mirror_url='http://mirror'),
+                mock.call(['java'], mirror_url='http://mirror'),
+            ])
+
+    @mock.patch.object(utils.time, 'sleep')
+    @mock.patch.object(utils, 'run_as')
+    def test_wait_for_hdfs(self, run_as, sleep):
+        run_as.side_effect = [
+            utils.CalledProcessError(1, 'hdfs', 'Connection refused'),
+            'Safe mode is ON\nLive datanodes (1):\n',
+            'Live datanodes (1):\n',
+        ]
+        self.assertTrue(utils.wait_for_hdfs(300))
+        self.assertEqual(sleep.call_args_list, [mock.call(2), mock.call(4)])
+        run_as.assert_called_with('hdfs', 'hdfs', 'dfsadmin', '-report', capture_output=True)
+
+    @mock.patch.object(utils.time, 'sleep')
+    def test_wait_until(self, sleep):
+        results = iter([False, False, True])
+        self.assertTrue(utils.wait_until(lambda: next(results), interval=1))
+        self.assertEqual(sleep.call_args_list, [mock.call(1), mock.call(2)])
+
+    @mock.patch.object(utils.time, 'sleep')
+    @mock.patch.object(utils.time, 'time')
+    def test_wait_until_timeout(self, time, sleep):
+        time.side_effect = [0, 10, 31]
+        self.assertFalse(utils.wait_until(lambda: False, timeout=30))
+        sleep.assert_called_once_with(0.5)
+
 
 if __name__ == '__main__':
     unittest.main()